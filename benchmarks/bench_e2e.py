@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+End to end benchmark of whole traces through main.main(), in process. Run
+from the repository root:
+
+    python3 -m benchmarks.bench_e2e [options] [TRACE ...]
+
+The traces are the test_cases/ corpus, or the given ones, plus synthetic
+traces from benchmarks.gen_trace. The options of main.py are taken too and
+apply to every run, e.g. --storage columnar.
+
+For every trace the results hold the best wall time of --runs runs with the
+output thrown away, the commands per second, the peak memory traced by
+tracemalloc over another run and the latency of every command type, timed
+over one more run. They are written as JSON with -o.
+
+With --baseline, a results file written before, the commands per second and
+peak memory of the corpus as a whole and of every synthetic trace are
+compared with it. The test cases are too short to be compared one by one.
+Anything worse than the baseline by more than --tolerance, or a trace raising
+that did not before, is reported and the exit status is 1.
+"""
+import io
+import os
+import sys
+import glob
+import json
+import platform
+import argparse
+import tempfile
+import tracemalloc
+from time import perf_counter
+from contextlib import redirect_stdout
+
+import main as trace_main
+from benchmarks.gen_trace import generate, write_text
+from v2.results import BufferedSink, NullSink
+from v2.trace import StreamParser
+
+TEST_DIR = 'test_cases'
+CORPUS = 'corpus'
+
+# Name and benchmarks.gen_trace.generate() arguments of the synthetic traces,
+# with the number of transactions given by --transactions
+SYNTHETIC = [
+    ('synthetic-uniform', dict(skew=0.0)),
+    ('synthetic-skewed', dict(skew=1.2)),
+    ('synthetic-failures', dict(read_only=0.3, fail_rate=0.005,
+                                recover_rate=0.05)),
+]
+
+
+def timed(commands, latencies):
+    """
+        Yields commands, adding to latencies[type] the time until the next
+        one is asked for, which is the time main.run() took to run it.
+    """
+    for cmd in commands:
+        if cmd.type is None:
+            yield cmd
+            continue
+        start = perf_counter()
+        yield cmd
+        latencies.setdefault(cmd.type.name, []).append(perf_counter() - start)
+
+
+def summary(latencies):
+    """
+        Count, mean, median, 99th percentile and maximum in microseconds of
+        a list of latencies in seconds.
+    """
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'count': count,
+        'mean_us': sum(latencies) / count * 1e6,
+        'p50_us': latencies[count // 2] * 1e6,
+        'p99_us': latencies[min(count - 1, count * 99 // 100)] * 1e6,
+        'max_us': latencies[-1] * 1e6,
+    }
+
+
+def run_main(args):
+    """
+        Runs main.main() with the output thrown away.
+    """
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        trace_main.main(args)
+
+
+def bench_trace(path, args, runs):
+    """
+        Returns the results of the trace at path, or its error if main.main()
+        raises on it. args are the main.py options.
+    """
+    args = argparse.Namespace(**vars(args))
+    args.command = None
+    args.input_file = path
+    try:
+        best = None
+        for _ in range(runs):
+            start = perf_counter()
+            run_main(args)
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        tracemalloc.start()
+        run_main(args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        latencies = {}
+        sink = BufferedSink(io.StringIO(), not args.min_output,
+                            not args.no_write_log)
+        tm = trace_main.make_tm(args, sink)
+        with open(path, 'rb') as fp:
+            trace_main.run(tm, timed(StreamParser(fp), latencies))
+    except Exception as e:
+        tracemalloc.stop()
+        return {'error': repr(e)}
+    commands = sum(len(l) for l in latencies.values())
+    return {
+        'commands': commands,
+        'wall_s': best,
+        'commands_per_s': commands / best,
+        'peak_kib': peak / 1024,
+        'latency': {type_: summary(l) for type_, l in latencies.items()},
+    }
+
+
+def corpus_total(results, names):
+    """
+        The traces of names that ran, taken as one, and the names of those
+        that raised.
+    """
+    ran = [results[name] for name in names if 'error' not in results[name]]
+    commands = sum(r['commands'] for r in ran)
+    wall = sum(r['wall_s'] for r in ran)
+    return {
+        'traces': len(ran),
+        'failed': sorted(name for name in names if 'error' in results[name]),
+        'commands': commands,
+        'wall_s': wall,
+        'commands_per_s': commands / wall if wall else 0.0,
+        'peak_kib': max((r['peak_kib'] for r in ran), default=0.0),
+    }
+
+
+def synthesize(directory, args, transactions):
+    """
+        Writes the SYNTHETIC traces to directory and returns their paths by
+        name. They are generated with the main.py options they run with.
+    """
+    paths = {}
+    for name, params in SYNTHETIC:
+        paths[name] = os.path.join(directory, name + '.txt')
+        commands = generate(trace_main.make_tm(args, NullSink()),
+                            transactions=transactions, **params)
+        with open(paths[name], 'w') as out:
+            write_text(commands, out)
+    return paths
+
+
+def compare(gated, baseline, tolerance):
+    """
+        Prints how every gated result compares with the baseline and returns
+        the names of those that got worse by more than tolerance.
+    """
+    regressed = []
+    print('{:<24} {:>14} {:>14} {:>8} {:>12} {:>12} {:>8}'.format(
+        'trace', 'commands/s', 'baseline', 'change', 'peak KiB',
+        'baseline', 'change'))
+    for name, result in gated.items():
+        before = baseline.get(name)
+        if before is None or 'error' in before:
+            print('{:<24} no baseline'.format(name))
+            continue
+        failed = (set(result.get('failed', ())) - set(before.get('failed', ()))
+                  if 'error' not in result else [result['error']])
+        if failed:
+            print('{:<24} failed: {}  REGRESSION'.format(
+                name, ', '.join(sorted(failed))))
+            regressed.append(name)
+            continue
+        speed = result['commands_per_s'] / before['commands_per_s'] - 1
+        memory = result['peak_kib'] / before['peak_kib'] - 1
+        worse = speed < -tolerance or memory > tolerance
+        print('{:<24} {:>14,.0f} {:>14,.0f} {:>+7.1%} {:>12,.1f} {:>12,.1f} '
+              '{:>+7.1%}{}'.format(name, result['commands_per_s'],
+                                   before['commands_per_s'], speed,
+                                   result['peak_kib'], before['peak_kib'],
+                                   memory, '  REGRESSION' if worse else ''))
+        if worse:
+            regressed.append(name)
+    return regressed
+
+
+def gated_results(results):
+    return dict([(CORPUS, results[CORPUS])] +
+                [(name, results['traces'][name]) for name, _ in SYNTHETIC
+                 if name in results['traces']])
+
+
+def main(args):
+    traces = args.traces or sorted(glob.glob(os.path.join(TEST_DIR, '*.txt')))
+    corpus = {os.path.basename(path): path for path in traces}
+    options = vars(trace_main.run_options().parse_args([]))
+    results = {
+        'python': platform.python_version(),
+        'options': {name: getattr(args, name) for name in options},
+        'traces': {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic = (synthesize(directory, args, args.transactions)
+                     if args.transactions else {})
+        for name, path in list(corpus.items()) + list(synthetic.items()):
+            result = bench_trace(path, args, args.runs)
+            results['traces'][name] = result
+            print('{:<24} {}'.format(name, result['error'] if 'error' in result
+                                     else '{:,.0f} commands/s'.format(
+                                         result['commands_per_s'])),
+                  file=sys.stderr)
+    results[CORPUS] = corpus_total(results['traces'], corpus)
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = gated_results(json.load(fp))
+        regressed = compare(gated_results(results), baseline, args.tolerance)
+        if regressed:
+            sys.exit('Regressions: {}'.format(', '.join(regressed)))
+    else:
+        for name, result in gated_results(results).items():
+            print('{:<24} {:>14,.0f} commands/s {:>12,.1f} KiB peak'.format(
+                name, result['commands_per_s'], result['peak_kib']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark whole traces and compare with a baseline',
+        parents=[trace_main.run_options()])
+    parser.add_argument('traces', metavar='TRACE', type=str, nargs='*',
+                        help='traces to run instead of {}/*.txt'
+                        .format(TEST_DIR))
+    parser.add_argument('-o', '--output', metavar='FILE', type=str,
+                        default=None, help='write the results as JSON')
+    parser.add_argument('--baseline', metavar='FILE', type=str, default=None,
+                        help='results to compare with')
+    parser.add_argument('--tolerance', metavar='FRACTION', type=float,
+                        default=0.1, help='slowdown or memory growth allowed '
+                        'before a regression is reported')
+    parser.add_argument('--runs', metavar='N', type=int, default=3,
+                        help='keep the best wall time of N runs')
+    parser.add_argument('--transactions', metavar='N', type=int,
+                        default=5000, help='transactions of each synthetic '
+                        'trace (0 for none)')
+    main(parser.parse_args())
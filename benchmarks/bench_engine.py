@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks of the engine: Lock requests under growing queue depths,
+reads of long version chains, Database.find_available and deadlock detection
+over growing waits-for graphs. Run from the repository root:
+
+    python3 -m benchmarks.bench_engine [--filter TEXT] [--runs N] [--ops N]
+
+Every benchmark reports its operations per second (best of --runs), then the
+memory traced by tracemalloc over one more run: the peak above what was
+allocated before it, and the bytes per operation still allocated after it.
+The memory run is separate as tracing slows everything down.
+"""
+import random
+import argparse
+import tracemalloc
+from time import perf_counter
+
+from v2.lock_manager import Lock, WaitsForGraph
+from v2.results import NullSink
+from v2.sites import Site, SiteEntry, Storage
+from v2.topology import Topology
+from v2.transaction_manager import Database, DetectPolicy, TransactionManager
+
+QUEUE_DEPTHS = (0, 10, 100, 1000)
+CHAIN_LENGTHS = (1, 10, 100, 1000)
+SITE_COUNTS = (10, 100, 1000)
+GRAPH_SIZES = (10, 100, 1000, 5000)
+
+
+# Each benchmark takes its size and the number of operations to run and
+# returns a function running them on fresh state, and how many it runs.
+
+def lock_with(readers=0, writer=False, queued=0):
+    """
+        A Lock held by readers 1 to readers, or by writer 0, with write
+        requests of queued transactions after them waiting.
+    """
+    lock = Lock(WaitsForGraph())
+    if writer:
+        lock.wlock(0)
+    for tid in range(1, readers + 1):
+        lock.rlock(tid)
+    for tid in range(readers + 1, readers + queued + 1):
+        lock.wlock(tid)
+    return lock
+
+
+def bench_rlock(depth, ops):
+    """
+        A read lock taken and released next to depth readers.
+    """
+    lock = lock_with(readers=depth)
+    tid = depth + 1
+
+    def run():
+        for _ in range(ops):
+            lock.rlock(tid)
+            lock.unlock(tid)
+    return run, 2 * ops
+
+
+def bench_wlock(depth, ops):
+    """
+        A write request queued behind depth others, then withdrawn.
+    """
+    lock = lock_with(writer=True, queued=depth)
+    tid = depth + 1
+
+    def run():
+        for _ in range(ops):
+            lock.wlock(tid)
+            lock.unlock(tid)
+    return run, 2 * ops
+
+
+def bench_upgrade(depth, ops):
+    """
+        A read lock upgraded while depth other readers hold the lock, so the
+        upgrade waits at the front of the queue, then released.
+    """
+    lock = lock_with(readers=depth)
+    tid = depth + 1
+
+    def run():
+        for _ in range(ops):
+            lock.rlock(tid)
+            lock.upgrade(tid)
+            lock.unlock(tid)
+    return run, 3 * ops
+
+
+def bench_unlock(depth, ops):
+    """
+        The write lock handed to the head of a queue of depth writers, the
+        old holder queueing again at the tail.
+    """
+    lock = lock_with(writer=True, queued=depth)
+
+    def run():
+        holder = 0
+        for _ in range(ops):
+            granted = lock.unlock(holder)
+            lock.wlock(holder)
+            if granted:
+                holder = granted[0]
+    return run, 2 * ops
+
+
+def versions_read(length, ops):
+    """
+        ops random versions to read from a chain of versions 1 to length.
+    """
+    rng = random.Random(length)
+    return [rng.randint(1, length) for _ in range(ops)]
+
+
+def bench_entry_read(length, ops):
+    """
+        SiteEntry.read_atbefore on an entry with length versions.
+    """
+    entry = SiteEntry(1, 1)
+    for version in range(1, length + 1):
+        entry.write(version, version)
+    versions = versions_read(length, ops)
+
+    def run():
+        for version in versions:
+            entry.read_atbefore(version)
+    return run, ops
+
+
+def bench_column_read(length, ops):
+    """
+        The same reads from the columnar storage engine.
+    """
+    store = Site(1, storage=Storage.columnar)._store
+    for version in range(1, length + 1):
+        store.write(2, version, version)
+    versions = versions_read(length, ops)
+
+    def run():
+        for version in versions:
+            store.read_atbefore(2, version)
+    return run, ops
+
+
+def database(sitec):
+    """
+        A Database whose first half of sites failed and recovered, so the
+        replicated copies there are stale and skipped by find_available().
+    """
+    db = Database(topology=Topology(sitec, 20))
+    for site in range(1, sitec // 2 + 1):
+        db.fail(site)
+        db.recover(site)
+    return db
+
+
+def bench_find_available(sitec, ops):
+    """
+        find_available() of the first up copy that is not stale, as for a
+        read.
+    """
+    db = database(sitec)
+    variables = [var % 20 + 1 for var in range(ops)]
+
+    def run():
+        for var in variables:
+            db.find_available(var)
+    return run, ops
+
+
+def bench_find_writable(sitec, ops):
+    """
+        find_available() of every up site, as for a write.
+    """
+    db = database(sitec)
+    variables = [var % 20 + 1 for var in range(ops)]
+
+    def run():
+        for var in variables:
+            db.find_available(var, all=True)
+    return run, ops
+
+
+def waiting_tm(size, ring):
+    """
+        A TransactionManager where each of size transactions holds a write
+        lock and waits for the next one's, in a chain or, with ring, a
+        single cycle through all of them. Detection is left to the caller.
+    """
+    tm = TransactionManager(detect=DetectPolicy.interval,
+                            detect_interval=1 << 62,
+                            topology=Topology(1, size, lambda var, sitec: [1]),
+                            sink=NullSink())
+    for tid in range(1, size + 1):
+        tm.new_txn(tid)
+        tm.write(tid, tid, tid)
+    for tid in range(1, size if not ring else size + 1):
+        tm.write(tid, tid % size + 1, 0)
+    return tm
+
+
+def bench_detect_chain(size, ops):
+    """
+        dl_detect() walking a chain of size waiting transactions, without
+        any deadlock. ops is ignored, as a detection needs a fresh graph.
+    """
+    tm = waiting_tm(size, ring=False)
+    return tm.dl_detect, 1
+
+
+def bench_detect_ring(size, ops):
+    """
+        dl_detect() finding and breaking a cycle of size transactions.
+    """
+    tm = waiting_tm(size, ring=True)
+    return tm.dl_detect, 1
+
+
+BENCHMARKS = [
+    ('Lock.rlock+unlock', 'readers', QUEUE_DEPTHS, bench_rlock),
+    ('Lock.wlock+unlock', 'queued', QUEUE_DEPTHS, bench_wlock),
+    ('Lock.upgrade', 'readers', QUEUE_DEPTHS, bench_upgrade),
+    ('Lock.unlock handoff', 'queued', QUEUE_DEPTHS, bench_unlock),
+    ('SiteEntry.read_atbefore', 'versions', CHAIN_LENGTHS, bench_entry_read),
+    ('ColumnStore.read_atbefore', 'versions', CHAIN_LENGTHS,
+     bench_column_read),
+    ('Database.find_available', 'sites', SITE_COUNTS, bench_find_available),
+    ('find_available(all=True)', 'sites', SITE_COUNTS, bench_find_writable),
+    ('dl_detect chain', 'txns', GRAPH_SIZES, bench_detect_chain),
+    ('dl_detect ring', 'txns', GRAPH_SIZES, bench_detect_ring),
+]
+
+
+def measure(bench, size, ops, runs):
+    """
+        Returns the operations per second of the best of runs, the peak
+        traced memory in bytes and the bytes per operation left allocated.
+    """
+    best = None
+    for _ in range(runs):
+        run, count = bench(size, ops)
+        start = perf_counter()
+        run()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    run, count = bench(size, ops)
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count / best, peak - base, (current - base) / count
+
+
+def main(args):
+    print('{:<40} {:>14} {:>12} {:>12}'.format(
+        'benchmark', 'ops/s', 'peak KiB', 'net B/op'))
+    for name, unit, sizes, bench in BENCHMARKS:
+        if args.filter and args.filter.lower() not in name.lower():
+            continue
+        for size in sizes:
+            rate, peak, net = measure(bench, size, args.ops, args.runs)
+            print('{:<40} {:>14,.0f} {:>12.1f} {:>12.1f}'.format(
+                '{} {}={}'.format(name, unit, size), rate, peak / 1024, net))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Microbenchmarks of locks, versions, sites and deadlock '
+        'detection')
+    parser.add_argument('--filter', metavar='TEXT', type=str, default=None,
+                        help='only run the benchmarks whose name contains '
+                        'TEXT')
+    parser.add_argument('--runs', metavar='N', type=int, default=3,
+                        help='keep the best of N runs')
+    parser.add_argument('--ops', metavar='N', type=int, default=10000,
+                        help='operations per run')
+    main(parser.parse_args())
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of trace parsing and command dispatch. Compares the combined
+regex of v2.trace.Parser and the COMMANDS table of v2.trace.do_cmd with the previous
+approach of trying one regex per command in turn and dispatching through an
+if/elif chain. Run from the repository root:
+
+    python3 -m benchmarks.bench_parser [TRACE] [--repeat N]
+"""
+import re
+import sys
+import time
+import logging
+import argparse
+
+from v2.trace import Command, CommandType, Parser, do_cmd
+
+LEGACY_PATTERNS = {
+    CommandType.begin: re.compile(r'begin\(t([0-9]+)\)(//|$)'),
+    CommandType.beginRO: re.compile(r'beginro\(t([0-9]+)\)(//|$)'),
+    CommandType.read: re.compile(r'r\(t([0-9]+),x([0-9]+)\)(//|$)'),
+    CommandType.write: re.compile(r'w\(t([0-9]+),x([0-9]+),([0-9]+)\)(//|$)'),
+    CommandType.dump_all: re.compile(r'dump\(\)(//|$)'),
+    CommandType.dump_site: re.compile(r'dump\(([0-9]+)\)(//|$)'),
+    CommandType.dump_variable: re.compile(r'dump\(x([0-9]+)\)(//|$)'),
+    CommandType.end: re.compile(r'end\(t([0-9]+)\)(//|$)'),
+    CommandType.fail: re.compile(r'fail\(([0-9]+)\)(//|$)'),
+    CommandType.recover: re.compile(r'recover\(([0-9]+)\)(//|$)'),
+    None: re.compile(r'\s*(//|$)')
+}
+
+
+def legacy_parse(lines):
+    for oline in lines:
+        line = oline.lower().replace(' ', '').replace('\t', '')
+        for type_, pat in LEGACY_PATTERNS.items():
+            match = pat.match(line)
+            if match:
+                yield Command(
+                    type_, tuple(map(int, match.groups()[:-1]))
+                    if type_ else oline)
+                break
+        else:
+            raise ValueError('No matches for line: {}'.format(oline))
+
+
+def parses(line):
+    try:
+        next(legacy_parse([line]))
+    except ValueError:
+        return False
+    return True
+
+
+def legacy_do_cmd(tm, cmd):
+    if cmd.type == CommandType.begin:
+        tm.new_txn(cmd.args[0])
+    elif cmd.type == CommandType.beginRO:
+        tm.new_txn(cmd.args[0], read_only=True)
+    elif cmd.type == CommandType.read:
+        tm.read(cmd.args[0], cmd.args[1])
+    elif cmd.type == CommandType.write:
+        tm.write(cmd.args[0], cmd.args[1], cmd.args[2])
+    elif cmd.type == CommandType.dump_all:
+        tm.dump()
+    elif cmd.type == CommandType.dump_site:
+        tm.dump(site=cmd.args[0])
+    elif cmd.type == CommandType.dump_variable:
+        tm.dump(var=cmd.args[0])
+    elif cmd.type == CommandType.end:
+        tm.finish_txn(cmd.args[0])
+    elif cmd.type == CommandType.fail:
+        tm.fail(cmd.args[0])
+    elif cmd.type == CommandType.recover:
+        tm.recover(cmd.args[0])
+
+
+class NullTM(object):
+    """
+        Takes every call do_cmd makes and does nothing, so only the dispatch
+        is timed.
+    """
+    def new_txn(self, tid, read_only=False):
+        pass
+
+    def read(self, tid, var):
+        pass
+
+    def write(self, tid, var, value):
+        pass
+
+    def dump(self, var=None, site=None):
+        pass
+
+    def finish_txn(self, tid):
+        pass
+
+    def fail(self, site):
+        pass
+
+    def recover(self, site):
+        pass
+
+
+def best_of(runs, fn, *args):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(name, count, legacy, current):
+    print('{:<10} legacy {:>10.0f}/s  combined {:>10.0f}/s  speedup {:.2f}x'
+          .format(name, count / legacy, count / current, legacy / current))
+
+
+def main(args):
+    # The parser logs at info level, keep it quiet
+    logging.getLogger('txn_manager').setLevel(logging.WARNING)
+    with open(args.trace) as fp:
+        lines = fp.readlines()
+    # all_tests.txt also holds the expected output of each test
+    lines = [line for line in lines if parses(line)] * args.repeat
+
+    legacy_cmds = list(legacy_parse(lines))
+    cmds = list(Parser(lines))
+    if cmds != legacy_cmds:
+        sys.exit('Parsers disagree on {}'.format(args.trace))
+    print('{} lines, {} commands, best of {} runs'.format(
+        len(lines), sum(1 for c in cmds if c.type is not None), args.runs))
+
+    report('parse', len(lines),
+           best_of(args.runs, lambda: list(legacy_parse(lines))),
+           best_of(args.runs, lambda: list(Parser(lines))))
+
+    cmds = [c for c in cmds if c.type is not None]
+    tm = NullTM()
+
+    def dispatch(fn):
+        for cmd in cmds:
+            fn(tm, cmd)
+    report('dispatch', len(cmds), best_of(args.runs, dispatch, legacy_do_cmd),
+           best_of(args.runs, dispatch, do_cmd))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark trace parsing and command dispatch')
+    parser.add_argument('trace', metavar='TRACE', type=str, nargs='?',
+                        default='test_cases/all_tests.txt',
+                        help='trace to parse')
+    parser.add_argument('--repeat', metavar='N', type=int, default=200,
+                        help='number of copies of the trace to parse')
+    parser.add_argument('--runs', metavar='N', type=int, default=5,
+                        help='keep the best of N runs')
+    main(parser.parse_args())
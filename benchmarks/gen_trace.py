@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Generates synthetic traces in the command grammar of test_cases/, for
+benchmarks far larger than the hand-written tests. The same parameters and
+seed always give the same trace. Run from the repository root:
+
+    python3 -m benchmarks.gen_trace [options] [-o OUT] [--compile]
+
+A trace runs about transactions * (length + 2) commands: a begin, length
+accesses on average and an end per transaction, plus the failures,
+recoveries and dumps. Up to concurrency transactions are open at a time and
+each command goes to one of them picked at random, so accesses interleave as
+in the tests. Variables are picked with a Zipfian skew (0 for uniform) over a
+shuffled order of the variables, so the hot ones are not always x1, x2, ...
+
+As in the hand-written tests, a blocked transaction issues nothing until it
+is woken up, and an aborted one nothing at all. The trace is run through a
+TransactionManager while it is generated to know which transactions those
+are, so the options of main.py that change what blocks or aborts are taken
+too and the trace should be run with the same ones.
+"""
+import sys
+import random
+import argparse
+from bisect import bisect
+
+from main import make_tm, run_options
+from v2.results import NullSink
+from v2.trace import Command, CommandType, compile_trace, do_cmd
+
+FORMATS = {
+    CommandType.begin: 'begin(T{})\n',
+    CommandType.beginRO: 'beginRO(T{})\n',
+    CommandType.read: 'R(T{},x{})\n',
+    CommandType.write: 'W(T{},x{},{})\n',
+    CommandType.dump_all: 'dump()\n',
+    CommandType.dump_site: 'dump({})\n',
+    CommandType.dump_variable: 'dump(x{})\n',
+    CommandType.end: 'end(T{})\n',
+    CommandType.fail: 'fail({})\n',
+    CommandType.recover: 'recover({})\n',
+}
+
+# Lines handed to the output file at once
+WRITE_BATCH = 1 << 14
+
+
+def zipf(items, skew):
+    """
+        Returns a function of a random.Random picking items[k] with a
+        probability proportional to 1 / (k + 1) ** skew.
+    """
+    cum_weights = []
+    total = 0.0
+    for rank in range(1, len(items) + 1):
+        total += rank ** -skew
+        cum_weights.append(total)
+    # Guards against rounding picking past the last item
+    last = len(items) - 1
+
+    def pick(rng):
+        return items[min(bisect(cum_weights, rng.random() * total), last)]
+    return pick
+
+
+def generate(tm, transactions=1000, concurrency=10, reads=0.5, read_only=0.1,
+             skew=0.99, length=5, fail_rate=0.0, recover_rate=0.01,
+             dump_rate=0.0, seed=0):
+    """
+        Yields the Commands of a trace, each one run on the
+        TransactionManager tm first.
+
+        reads is the fraction of accesses of read-write transactions that are
+        reads and read_only the fraction of transactions that are read-only.
+        The number of accesses of a transaction is drawn uniformly from 1 to
+        2 * length - 1. fail_rate, recover_rate and dump_rate are the
+        probabilities after each command that an up site fails (the last one
+        never does), that a failed site recovers and that every site is
+        dumped. Written values count up from 1, so every write is told apart.
+
+        When every open transaction is blocked, a failed site recovers, or
+        else the oldest transaction ends, as some wait for a write that may
+        never come. Sites still failed at the end recover, then a dump()
+        closes the trace.
+    """
+    if transactions < 1 or concurrency < 1 or length < 1:
+        raise ValueError('Need at least one transaction, one open '
+                         'transaction and one access per transaction')
+    for name, p in (('reads', reads), ('read_only', read_only),
+                    ('fail_rate', fail_rate), ('recover_rate', recover_rate),
+                    ('dump_rate', dump_rate)):
+        if not 0 <= p <= 1:
+            raise ValueError('{} must be between 0 and 1, not {}'
+                             .format(name, p))
+    if skew < 0:
+        raise ValueError('Skew must not be negative')
+    topology = tm.topology
+    rng = random.Random(seed)
+
+    variables = list(topology.variables)
+    rng.shuffle(variables)
+    pick_var = zipf(variables, skew)
+
+    def issue(type_, *args):
+        cmd = Command(type_, args)
+        do_cmd(tm, cmd)
+        return cmd
+
+    # [tid, accesses left, read-only] of the open transactions, oldest first
+    active = []
+    started = 0
+    up = list(topology.sites)
+    down = []
+    value = 0
+
+    def begin():
+        nonlocal started
+        started += 1
+        ro = rng.random() < read_only
+        active.append([started, rng.randint(1, 2 * length - 1), ro])
+        return issue(CommandType.beginRO if ro else CommandType.begin,
+                     started)
+
+    def switch(sites, to):
+        i = rng.randrange(len(sites))
+        sites[i], sites[-1] = sites[-1], sites[i]
+        to.append(sites.pop())
+        return to[-1]
+
+    while active or started < transactions:
+        while len(active) < concurrency and started < transactions:
+            yield begin()
+
+        runnable = [txn for txn in active if not tm.blocked(txn[0])]
+        if not runnable:
+            if down:
+                yield issue(CommandType.recover, switch(down, up))
+            else:
+                yield issue(CommandType.end, active.pop(0)[0])
+            active = [txn for txn in active if tm.active(txn[0])]
+            continue
+
+        txn = rng.choice(runnable)
+        if txn[1]:
+            txn[1] -= 1
+            if txn[2] or rng.random() < reads:
+                yield issue(CommandType.read, txn[0], pick_var(rng))
+            else:
+                value += 1
+                yield issue(CommandType.write, txn[0], pick_var(rng), value)
+        else:
+            active.remove(txn)
+            yield issue(CommandType.end, txn[0])
+
+        if fail_rate and len(up) > 1 and rng.random() < fail_rate:
+            yield issue(CommandType.fail, switch(up, down))
+        if down and rng.random() < recover_rate:
+            yield issue(CommandType.recover, switch(down, up))
+        if dump_rate and rng.random() < dump_rate:
+            yield issue(CommandType.dump_all)
+        # Failures and deadlocks abort transactions
+        active = [txn for txn in active if tm.active(txn[0])]
+
+    for site in sorted(down):
+        yield issue(CommandType.recover, site)
+    yield issue(CommandType.dump_all)
+
+
+def write_text(commands, out, header=None):
+    """
+        Writes commands to the text file out, one per line, after header as a
+        comment if given. Returns the number of commands written.
+    """
+    if header is not None:
+        out.write('// {}\n'.format(header))
+    count = 0
+    lines = []
+    for cmd in commands:
+        lines.append(FORMATS[cmd.type].format(*cmd.args))
+        if len(lines) >= WRITE_BATCH:
+            out.writelines(lines)
+            count += len(lines)
+            lines = []
+    out.writelines(lines)
+    return count + len(lines)
+
+
+def main(args, argv):
+    commands = generate(make_tm(args, NullSink()), args.transactions,
+                        args.concurrency, args.reads, args.read_only,
+                        args.skew, args.length, args.fail_rate,
+                        args.recover_rate, args.dump_rate, args.seed)
+    if args.compile:
+        if args.output is None:
+            sys.exit('--compile needs an output file')
+        with open(args.output, 'wb') as out:
+            count = compile_trace(commands, out)
+    else:
+        # The arguments are kept in the trace to generate it again
+        header = 'gen_trace {}'.format(' '.join(argv))
+        if args.output is None:
+            count = write_text(commands, sys.stdout, header)
+        else:
+            with open(args.output, 'w') as out:
+                count = write_text(commands, out, header)
+    print('{} commands'.format(count), file=sys.stderr)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic trace for main.py',
+        parents=[run_options()])
+    parser.add_argument('--transactions', metavar='N', type=int, default=1000,
+                        help='number of transactions')
+    parser.add_argument('--concurrency', metavar='N', type=int, default=10,
+                        help='number of transactions open at a time')
+    parser.add_argument('--reads', metavar='P', type=float, default=0.5,
+                        help='fraction of the accesses of read-write '
+                        'transactions that are reads')
+    parser.add_argument('--read-only', metavar='P', type=float, default=0.1,
+                        help='fraction of read-only transactions')
+    parser.add_argument('--skew', metavar='S', type=float, default=0.99,
+                        help='Zipf exponent of the variable picked by an '
+                        'access (0 for uniform)')
+    parser.add_argument('--length', metavar='N', type=int, default=5,
+                        help='average number of accesses per transaction')
+    parser.add_argument('--fail-rate', metavar='P', type=float, default=0.0,
+                        help='probability after each command that a site '
+                        'fails')
+    parser.add_argument('--recover-rate', metavar='P', type=float,
+                        default=0.01, help='probability after each command '
+                        'that a failed site recovers')
+    parser.add_argument('--dump-rate', metavar='P', type=float, default=0.0,
+                        help='probability after each command of a dump()')
+    parser.add_argument('--seed', metavar='N', type=int, default=0,
+                        help='random seed')
+    parser.add_argument('-o', '--output', metavar='OUT', type=str,
+                        default=None, help='output file (stdout by default)')
+    parser.add_argument('--compile', action='store_true',
+                        help='write a compiled trace for main.py replay')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_args(sys.argv[1:]), sys.argv[1:])
@@ -5,18 +5,22 @@ Authors Conrad Christensen
 Classes:
     main: loops over every command in input file and calls relevant function
           in TransactionManager
-    Parser: Class that matches regular expressions to file input to determine
-            what command is input'd and what arguments are provided
+    compile_main: compiles a text trace for main.py replay
 """
 
-import re
 import sys
-import enum
+import queue
 import logging
 import argparse
-from collections import namedtuple
+from logging.handlers import QueueHandler, QueueListener
 
-from v2.transaction_manager import TransactionManager
+from v2.transaction_manager import TransactionManager, DetectPolicy
+from v2.lock_manager import Prevention
+from v2.topology import Topology
+from v2.sites import Storage
+from v2.results import BufferedSink
+from v2.stats import Contention, Stats
+from v2.trace import StreamParser, compile_trace, do_cmd, read_compiled
 
 # Logger handling done in global scope to make logger available. Set up is done
 # here but other classes can simply grab the logger with the following line.
@@ -30,149 +34,176 @@ LOG_LEVELS = {
     'none': logging.NOTSET,
 }
 
-# Command object defined along with the types of commands
-Command = namedtuple('Command', ['type', 'args'])
-
-class CommandType(enum.Enum):
-    begin = 0
-    beginRO = 1
-    read = 2
-    write = 3
-    dump_all = 4
-    dump_site = 5
-    dump_variable = 6
-    end = 7
-    fail = 8
-    recover = 9
-
-
-class Parser(object):
-    # No front anchors needed because we use re.match, and back anchor is only
-    # required if no comment start is found
-    patterns = {
-        CommandType.begin: re.compile('begin\(t([0-9]+)\)(//|$)'),
-        CommandType.beginRO: re.compile('beginro\(t([0-9]+)\)(//|$)'),
-        CommandType.read: re.compile('r\(t([0-9]+),x([0-9]+)\)(//|$)'),
-        CommandType.write: re.compile('w\(t([0-9]+),x([0-9]+),([0-9]+)\)(//|$)'),
-        CommandType.dump_all: re.compile('dump\(\)(//|$)'),
-        CommandType.dump_site: re.compile('dump\(([0-9]+)\)(//|$)'),
-        CommandType.dump_variable: re.compile('dump\(x([0-9]+)\)(//|$)'),
-        CommandType.end: re.compile('end\(t([0-9]+)\)(//|$)'),
-        CommandType.fail: re.compile('fail\(([0-9]+)\)(//|$)'),
-        CommandType.recover: re.compile('recover\(([0-9]+)\)(//|$)'),
-        None: re.compile('\s*(//|$)')
-    }
-    def __init__(self, file_handle):
-        self._started_iter = False
-        self._iter = iter(file_handle)
-        logger.info("Create Parser object")
-
-    def __iter__(self):
-        """
-            Create iterator of the parser and returns. Note that the iterator
-            is just the parser itself (but this should be called to ensure
-            it only gets called once.
-        """
-        if self._started_iter:
-            raise ValueError('Cannot iterate twice')
-        self._started_iter = True
-        return self
-
-    def __next__(self):
-        """
-            This function pulls the next line of data from the file and returns
-            a Command object denoting the type and arguments (directly from the
-            regex match). If the line was a comment then a None type returned
-            with the argument replaced by the actual line read.
-        """
-        assert self._started_iter, 'Must start iterator to call next'
-
-        oline = next(self._iter)
-        line = oline.lower().replace(' ', '').replace('\t', '')
-
-        for type_, pat in Parser.patterns.items():
-            match = pat.match(line)
-            if match:
-                # Note the groups()[:-1] is to drop the (#|$) group at the end
-                # which captures a comment or end-of-line for each match
-                return Command(
-                    type_, tuple(map(int, match.groups()[:-1]))
-                    if type_ else oline)
-
-        raise ValueError('No matches for line: {}'.format(oline))
-
-def do_cmd(tm, cmd):
-    if cmd.type == CommandType.begin:
-        logger.debug('Command {} for txn T{}'.format(cmd.type, cmd.args[0]))
-        tm.new_txn(cmd.args[0])
-    elif cmd.type == CommandType.beginRO:
-        logger.debug('Command {} for txn T{}'.format(cmd.type, cmd.args[0]))
-        tm.new_txn(cmd.args[0], read_only=True)
-    elif cmd.type == CommandType.read:
-        logger.debug('Command {} for txn T{} on var x{}'.format(
-            cmd.type, *cmd.args))
-        tm.read(cmd.args[0], cmd.args[1])
-    elif cmd.type == CommandType.write:
-        logger.debug('Command {} for txn T{} on var x{} and value {}'.format(
-            cmd.type, *cmd.args))
-        tm.write(cmd.args[0], cmd.args[1], cmd.args[2])
-    elif cmd.type == CommandType.dump_all:
-        logger.debug('Command {}'.format(cmd.type))
-        tm.dump()
-    elif cmd.type == CommandType.dump_site:
-        logger.debug('Command {} for site {}'.format(cmd.type, *cmd.args))
-        tm.dump(site=cmd.args[0])
-    elif cmd.type == CommandType.dump_variable:
-        logger.debug('Command {} for variable x{}'.format(cmd.type, *cmd.args))
-        tm.dump(var=cmd.args[0])
-    elif cmd.type == CommandType.end:
-        logger.debug('Command {} for txn T{}'.format(cmd.type, cmd.args[0]))
-        tm.finish_txn(cmd.args[0])
-    elif cmd.type == CommandType.fail:
-        logger.debug('Command {} for site {}'.format(cmd.type, *cmd.args))
-        tm.fail(cmd.args[0])
-    elif cmd.type == CommandType.recover:
-        logger.debug('Command {} for site {}'.format(cmd.type, *cmd.args))
-        tm.recover(cmd.args[0])
+def log_async():
+    """
+        Leaves only putting records on a queue to the logger. Formatting and
+        writing them is done by a thread of the returned QueueListener, which
+        has to be stopped to write what is left.
+    """
+    records = queue.SimpleQueue()
+    logger.removeHandler(LOG_HANDLER)
+    logger.addHandler(QueueHandler(records))
+    listener = QueueListener(records, LOG_HANDLER)
+    listener.start()
+    return listener
+
+def make_tm(args, sink=None):
+    return TransactionManager(full_output=not args.min_output,
+                              log_writes=not args.no_write_log,
+                              test15_opt=not args.no_rec_site_opt,
+                              detect=DetectPolicy[args.deadlock_detect],
+                              detect_interval=args.detect_interval,
+                              lock_timeout=args.lock_timeout,
+                              prevention=Prevention(args.prevention)
+                              if args.prevention else None,
+                              topology=Topology(args.sites, args.variables),
+                              gc_interval=args.gc_interval,
+                              storage=Storage(args.storage),
+                              sink=sink,
+                              stats=Stats() if args.stats else None,
+                              contention=Contention() if args.contention
+                              else None)
+
+def run(trans_man, commands):
+    for cmd in commands:
+        if cmd.type is None:
+            # Remove trailing new line
+            logger.info('Blank or comment line: %s', cmd.args[:-1])
+        else:
+            do_cmd(trans_man, cmd)
+    logger.info('Done with file')
+
+def compile_main(args):
+    with open(args.input_file, 'rb') as fp, open(args.output_file, 'wb') as out:
+        count = compile_trace(StreamParser(fp), out)
+    print('Compiled {} commands from {} to {}'.format(
+        count, args.input_file, args.output_file))
 
 def main(args):
+    if args.command == 'compile':
+        return compile_main(args)
     logger.setLevel(LOG_LEVELS[args.log_level])
-
-    trans_man = TransactionManager(full_output=not args.min_output,
-                                   log_writes=not args.no_write_log,
-                                   test15_opt=not args.no_rec_site_opt)
-    with (open(args.input_file, 'r') if args.input_file else sys.stdin) as fp:
-        parseit = iter(Parser(fp))
-        while True:
-            try:
-                cmd = next(parseit)
-                if cmd.type is None:
-                    # Remove trailing new line
-                    logger.info('Blank or comment line: {}'.format(cmd.args[:-1]))
-                else:
-                    do_cmd(trans_man, cmd)
-            except ValueError as e:
-                raise
-                logger.error(str(e)[:-1])
-                logger.error('Continueing...')
-            except StopIteration:
-                logger.info('Done with file')
-                break
+    listener = log_async() if args.log_async else None
+
+    # Output is written in blocks, unless it has to be interleaved with
+    # synchronous logs
+    interleave = args.log_level != 'none' and not args.log_async
+    sink = BufferedSink(sys.stdout, not args.min_output, not args.no_write_log,
+                        0 if interleave else 1 << 16)
+    trans_man = make_tm(args, sink)
+    try:
+        try:
+            if args.command == 'replay':
+                run(trans_man, read_compiled(args.input_file))
+            else:
+                # Read as bytes in large blocks, memory mapped for a file
+                with (open(args.input_file, 'rb') if args.input_file
+                      else sys.stdin.buffer) as fp:
+                    run(trans_man, StreamParser(fp))
+        finally:
+            sink.close()
+        logger.info('Version collection: %s', trans_man.gc_stats)
+        if args.stats:
+            with open(args.stats, 'w') as out:
+                trans_man.stats.dump(out)
+        if args.contention:
+            trans_man.contention.report(sys.stderr, args.contention)
+    finally:
+        if listener is not None:
+            listener.stop()
+
+def run_options():
+    """
+        Options of every command that runs a trace.
+    """
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument('--min-output', action='store_true',
+                         help='produce only minimum output specified in doc')
+    options.add_argument('--no-write-log', action='store_true',
+                         help='whether to stop logging of writes '
+                         '(only applicable with full output)')
+    options.add_argument('--no-rec-site-opt', action='store_true',
+                         help='turn off optimization that prevents deadlock '
+                         'in the case of test case 15 (writing to recovered '
+                         'site)')
+    options.add_argument('--deadlock-detect', metavar='POLICY', type=str,
+                         choices=[p.name for p in DetectPolicy],
+                         default='tick',
+                         help='when to run deadlock detection: every tick, '
+                         'only after an access blocks, every '
+                         '--detect-interval ticks, or never (rely on '
+                         '--lock-timeout)')
+    options.add_argument('--detect-interval', metavar='N', type=int,
+                         default=10, help='ticks between detections for the '
+                         'interval policy')
+    options.add_argument('--lock-timeout', metavar='N', type=int, default=None,
+                         help='abort transactions blocked on a lock for more '
+                         'than N ticks')
+    options.add_argument('--prevention', metavar='POLICY', type=str,
+                         choices=[p.value for p in Prevention], default=None,
+                         help='prevent deadlocks with wait-die or wound-wait '
+                         'instead of detecting them')
+    options.add_argument('--sites', metavar='N', type=int, default=10,
+                         help='number of sites')
+    options.add_argument('--variables', metavar='N', type=int, default=20,
+                         help='number of variables')
+    options.add_argument('--gc-interval', metavar='N', type=int, default=0,
+                         help='collect versions no read-only transaction can '
+                         'read every N ticks (0 to never collect)')
+    options.add_argument('--storage', metavar='ENGINE', type=str,
+                         choices=[s.value for s in Storage], default='entries',
+                         help='storage engine of the sites: a SiteEntry per '
+                         'variable or array columns (integer values only)')
+    options.add_argument('--stats', metavar='FILE', type=str, default=None,
+                         help='write operation latencies, blocked ticks, '
+                         'retries, deadlock detection times and aborts as '
+                         'JSON to FILE')
+    options.add_argument('--contention', metavar='N', type=int, default=0,
+                         help='print the N variables and locks waited for '
+                         'the most to stderr at the end of the run, with '
+                         'their queue lengths, upgrade conflicts and '
+                         'deadlock cycles')
+    options.add_argument('--log-level', metavar='LEVEL', type=str,
+                         choices=['debug', 'info', 'none'], default='none',
+                         help='logging level')
+    options.add_argument('--log-async', action='store_true',
+                         help='write logs from a separate thread, so they no '
+                         'longer interleave with the output')
+    return options
+
+def parse_args(argv):
+    """
+        main.py [options] [IN_FILE] runs a text trace (stdin by default).
+        main.py compile IN_FILE OUT_FILE compiles one to the binary format of
+        v2.trace and main.py replay [options] BIN_FILE runs a compiled trace.
+        The subcommands are only looked for as the first argument, so a text
+        trace named like one can still be run as ./compile.
+    """
+    options = run_options()
+    if argv and argv[0] in ('compile', 'replay'):
+        parser = argparse.ArgumentParser(
+            description='Compile text traces and replay compiled ones')
+        subparsers = parser.add_subparsers(dest='command')
+        compiler = subparsers.add_parser(
+            'compile', help='compile a text trace into a binary one')
+        compiler.add_argument('input_file', metavar='IN_FILE', type=str,
+                              help='name of the text trace')
+        compiler.add_argument('output_file', metavar='OUT_FILE', type=str,
+                              help='name of the compiled trace to write')
+        replay = subparsers.add_parser(
+            'replay', parents=[options], help='run a compiled trace')
+        replay.add_argument('input_file', metavar='BIN_FILE', type=str,
+                            help='name of the compiled trace')
+    else:
+        parser = argparse.ArgumentParser(
+            description='Run distributed database on test file',
+            parents=[options],
+            epilog='Binary traces: main.py compile IN_FILE OUT_FILE and '
+            'main.py replay [options] BIN_FILE')
+        parser.add_argument('input_file', metavar='IN_FILE', type=str,
+                            default=None, nargs='?', help='name of input file')
+        parser.set_defaults(command=None)
+    return parser.parse_args(argv)
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        description='Run distributed database on test file')
-    parser.add_argument('input_file', metavar='IN_FILE', type=str,
-                        default=None, nargs='?', help='name of input file')
-    parser.add_argument('--min-output', action='store_true',
-                        help='produce only minimum output specified in doc')
-    parser.add_argument('--no-write-log', action='store_true',
-                        help='whether to stop logging of writes '
-                        '(only applicable with full output)')
-    parser.add_argument('--no-rec-site-opt', action='store_true',
-                        help='turn off optimization that prevents deadlock in'
-                        'the case of test case 15 (writing to recovered site)')
-    parser.add_argument('--log-level', metavar='LEVEL', type=str,
-                        choices=['debug', 'info', 'none'], default='none',
-                        help='logging level')
-    main(parser.parse_args())
+    main(parse_args(sys.argv[1:]))
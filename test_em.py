@@ -1,11 +1,27 @@
 #!/usr/bin/env python3
+"""
+Runs the unit tests of every v2 module and the end-to-end tests: each trace
+in test_cases/ goes through main.main() with a fresh TransactionManager and
+its output is compared with the one in test_cases/outputs/. Everything runs
+in process, fanned out over a process pool with a worker per core, and the
+time each test took is reported.
+"""
 
-import subprocess
-import glob
+import io
 import os
+import sys
+import glob
+import unittest
+from time import perf_counter
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+
+import main as trace_main
 
 TEST_DIR = 'test_cases'
 OUTPUT_DIR = 'test_cases/outputs'
+MODULES = ['transaction_manager', 'transaction', 'lock_manager', 'sites',
+           'topology', 'trace', 'results', 'stats', 'test_dl_detect']
 
 class Colors(object):
     blue = '\033[95m'
@@ -15,48 +31,92 @@ class Colors(object):
     bold = '\033[1m'
     underline = '\033[4m'
 
+def timed(job, arg):
+    start = perf_counter()
+    result = job(arg)
+    return result, perf_counter() - start
+
+def run_module(module):
+    """
+        Runs the unit tests of v2.module. Returns whether they passed, how
+        many ran and their report, with anything they printed.
+    """
+    report = io.StringIO()
+    suite = unittest.defaultTestLoader.loadTestsFromName('v2.' + module)
+    with redirect_stdout(report):
+        result = unittest.TextTestRunner(stream=report).run(suite)
+    return result.wasSuccessful(), result.testsRun, report.getvalue()
+
+def run_trace(path):
+    """
+        Runs the trace at path as main.py path --log-level none would.
+        Returns its output and the error it raised, if any, after which the
+        output stops as it would have.
+    """
+    out = io.StringIO()
+    error = None
+    with redirect_stdout(out):
+        try:
+            trace_main.main(trace_main.parse_args([path, '--log-level',
+                                                   'none']))
+        except Exception as e:
+            error = repr(e)
+    return out.getvalue(), error
+
 def main():
-    # First call all unit tests
-    for module in ['transaction_manager', 'transaction', 'lock_manager',
-                   'sites']:
-        print('Testing {}'.format(module))
-        subprocess.call(['python3', '-m', 'v2.{}'.format(module)])
-
-    # Then end-to-end tests
-    passed = 0
-    failed = []
-
-    for t in glob.glob(TEST_DIR + '/*.txt'):
-        read = OUTPUT_DIR + '/' + t[t.index('/')+1 :]
+    traces = []
+    for t in sorted(glob.glob(TEST_DIR + '/*.txt')):
+        read = OUTPUT_DIR + '/' + os.path.basename(t)
         if not os.path.exists(read):
             print('{}No output file {}{}'.format(Colors.blue, read,
                                                  Colors.end))
             continue
+        traces.append((t, read))
 
-        try:
-            out_py = subprocess.Popen(['python3', 'main.py', t, '--log-level', 'none'],
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE)
-            out_real = subprocess.Popen(['cat', read], stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
+    start = perf_counter()
+    with ProcessPoolExecutor(os.cpu_count()) as pool:
+        units = [(module, pool.submit(timed, run_module, module))
+                 for module in MODULES]
+        ends = [(t, read, pool.submit(timed, run_trace, t))
+                for t, read in traces]
 
-            if out_py.stdout.read() == out_real.stdout.read():
+        # First all unit tests
+        units_failed = []
+        for module, future in units:
+            (ok, count, report), elapsed = future.result()
+            print('Testing {:<32} {:>3} tests {:>8.3f}s {}'.format(
+                module, count, elapsed, 'OK' if ok else 'FAILED'))
+            if not ok:
+                print(report)
+                units_failed.append(module)
+
+        # Then end-to-end tests
+        passed = 0
+        failed = []
+        for t, read, future in ends:
+            (output, error), elapsed = future.result()
+            with open(read, 'rb') as fp:
+                ok = fp.read() == output.encode()
+            print('{:<48} {:>8.3f}s {}{}'.format(
+                t, elapsed, 'OK' if ok else 'FAILED',
+                ' ({})'.format(error) if error and not ok else ''))
+            if ok:
                 passed += 1
             else:
                 failed.append(t)
-        except Exception as e:
-            print(e)
-            print('Failed EXCEPTION', t)
-            failed.append(t)
 
-    for f in failed:
+    for f in units_failed + failed:
         print('{}{}Failed {}{}'.format(Colors.red, Colors.bold, f,
                                        Colors.end))
-    print('{}{}'.format(Colors.green if len(failed) == 0 else Colors.red,
-                        '-'*80))
-    print('Passed {}/{} end to end tests'.format(
-        passed, passed + len(failed)))
+    print('{}{}'.format(
+        Colors.green if not units_failed and not failed else Colors.red,
+        '-'*80))
+    print('Passed {}/{} unit test modules'.format(
+        len(MODULES) - len(units_failed), len(MODULES)))
+    print('Passed {}/{} end to end tests in {:.2f}s'.format(
+        passed, passed + len(failed), perf_counter() - start))
     print('{}{}'.format('-'*80, Colors.end))
+    return not units_failed and not failed
 
 if __name__ == '__main__':
-    main()
+    sys.exit(0 if main() else 1)
@@ -2,93 +2,437 @@
 Authors Conrad Christensen and Jane Liu
 
 Classes:
-    LockManager: class to manage 20 locks, one for every possible variable
-                 that a site might have.
+    LockManager: the locks of one site, one per variable in use. A Lock is
+                 created when its variable is first requested and dropped
+                 once nobody holds or waits for it.
     Lock: contains logic for determining who has a lock and who will receive
           it when it is released.
+    WaitsForGraph: waits-for graph shared by the lock managers of all sites.
+                   Locks keep it up to date as requests are queued, granted
+                   and released.
+    Prevention: deadlock prevention policies applied when a lock request has
+                to wait.
     TestLockManager: Unit tests for LockManager and Lock.
+    TestWaitsForGraph: Unit tests for WaitsForGraph.
 """
+import enum
 import logging
 import unittest
+from collections import Counter, defaultdict
 
 logger = logging.getLogger('txn_manager')
 
+class Prevention(enum.Enum):
+    """
+        Deadlock prevention by transaction timestamp, decided whenever a
+        request starts waiting for another transaction:
+            wait_die: an older requester waits, a younger one dies
+            wound_wait: an older requester wounds (aborts) the younger
+                        transaction it would wait for, a younger one waits
+        Either way the younger of the two is aborted, so waits only ever go
+        one way in timestamp order and no cycle can form.
+    """
+    wait_die = 'wait-die'
+    wound_wait = 'wound-wait'
+
+
+class WaitsForGraph(object):
+    """
+        Directed graph of transactions waiting for other transactions. An edge
+        can be contributed by several locks (e.g. a write to a replicated
+        variable queues at every site) so each edge keeps a count and only
+        disappears once every lock has dropped it.
+
+        A Lock is a node of the graph too, whose edges go to its holders and
+        are read straight from it. The request at the head of its queue has
+        a single edge to the lock, so it reaches every holder, and neither a
+        new head nor a new holder changes more than one edge.
+
+        Transactions that gained an edge since the last deadlock check are
+        remembered, since any new cycle must go through one of them.
+
+        With a prevention policy, timestamp maps a tid to its transaction
+        timestamp and every new edge is checked against the policy. The
+        transactions it dooms are collected for the transaction manager to
+        abort.
+    """
+    def __init__(self, prevention=None, timestamp=None):
+        self._out = {}
+        self._touched = {}
+        self._prevention = prevention
+        self._timestamp = timestamp
+        self._doomed = {}
+        self._decided = set()
+
+    def __getitem__(self, tid):
+        if isinstance(tid, Lock):
+            return tid._holders
+        return self._out.get(tid, {})
+
+    def __contains__(self, edge):
+        return edge[1] in self._waits_for(edge[0])
+
+    def __len__(self):
+        return len(self._out)
+
+    @property
+    def changed(self):
+        return len(self._touched) > 0
+
+    def add_edge(self, tid, waits_for):
+        out = self._out.setdefault(tid, {})
+        count = out.get(waits_for, 0)
+        out[waits_for] = count + 1
+        if count == 0:
+            self._touched[tid] = None
+            if self._prevention is not None:
+                self._prevent(tid, waits_for)
+
+    def add_holder(self, waiter, tid):
+        """
+            tid was granted a lock whose queue waiter is at the head of, so
+            waiter now waits for tid as well.
+        """
+        if waiter != tid:
+            self._touched[waiter] = None
+            if self._prevention is not None:
+                self._prevent(waiter, tid)
+
+    def _prevent(self, tid, waits_for):
+        if isinstance(waits_for, Lock):
+            for holder in self[waits_for]:
+                if holder != tid:
+                    self._prevent(tid, holder)
+            return
+        # A wait reached through several locks is only decided once
+        if (tid, waits_for) in self._decided:
+            return
+        older = self._timestamp(tid) < self._timestamp(waits_for)
+        if self._prevention == Prevention.wait_die and not older:
+            logger.info('T%s dies waiting for T%s', tid, waits_for)
+            self._doomed[tid] = None
+            self._decided.add((tid, waits_for))
+        elif self._prevention == Prevention.wound_wait and older:
+            logger.info('T%s wounds T%s', tid, waits_for)
+            self._doomed[waits_for] = None
+            self._decided.add((tid, waits_for))
+
+    @property
+    def doomed(self):
+        return len(self._doomed) > 0
+
+    def pop_doomed(self):
+        """
+            Returns the transactions doomed by the prevention policy since the
+            last call, oldest decision first.
+        """
+        doomed = list(self._doomed)
+        self._doomed = {}
+        self._decided = set()
+        return doomed
+
+    def remove_edge(self, tid, waits_for):
+        out = self._out[tid]
+        if out[waits_for] > 1:
+            out[waits_for] -= 1
+        else:
+            del out[waits_for]
+            if not out:
+                del self._out[tid]
+
+    def touched(self):
+        """
+            Transactions that gained an out edge since the last call to clear()
+            and are still waiting.
+        """
+        return [tid for tid in self._touched if tid in self._out]
+
+    def clear(self):
+        self._touched = {}
+
+    def _waits_for(self, tid):
+        """
+            The transactions tid waits for, through the locks it waits for.
+        """
+        waits_for = set()
+        for node in self[tid]:
+            if isinstance(node, Lock):
+                waits_for.update(holder for holder in self[node]
+                                 if holder != tid)
+            else:
+                waits_for.add(node)
+        return waits_for
+
+    def edges(self):
+        """
+            The edges between transactions, each lock a transaction waits for
+            replaced by its holders.
+        """
+        edges = {}
+        for tid in self._out:
+            waits_for = self._waits_for(tid)
+            if waits_for:
+                edges[tid] = waits_for
+        return edges
+
+    def components(self, roots, excluded=()):
+        """
+            Iterative Tarjan's algorithm over the part of the graph reachable
+            from roots, skipping the excluded transactions. Returns every
+            strongly connected component that contains a cycle, in O(V+E) and
+            without recursion so long wait chains are fine. The locks are
+            left out of the components returned, and a component with a
+            single transaction is only a request queued behind its own lock.
+        """
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        found = []
+        for root in roots:
+            if root in index or root in excluded:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self[root]))]
+            while work:
+                v, succ = work[-1]
+                for w in succ:
+                    if w in excluded:
+                        continue
+                    if w not in index:
+                        index[w] = low[w] = len(index)
+                        stack.append(w)
+                        on_stack.add(w)
+                        work.append((w, iter(self[w])))
+                        break
+                    elif w in on_stack:
+                        low[v] = min(low[v], index[w])
+                else:
+                    work.pop()
+                    if work:
+                        u = work[-1][0]
+                        low[u] = min(low[u], low[v])
+                    if low[v] == index[v]:
+                        comp = []
+                        while True:
+                            w = stack.pop()
+                            on_stack.remove(w)
+                            comp.append(w)
+                            if w == v:
+                                break
+                        comp = [tid for tid in comp
+                                if not isinstance(tid, Lock)]
+                        if len(comp) > 1 or v in self[v]:
+                            found.append(comp)
+        return found
+
+    def victims(self, choose):
+        """
+            Finds every deadlock reachable from the touched transactions and
+            returns the victims that break all of them. choose picks the victim
+            of a deadlocked component; the rest of that component is searched
+            again without the victim, as it may still hold a smaller cycle.
+            Clears the touched transactions.
+        """
+        victims = []
+        roots = self.touched()
+        while roots:
+            comps = self.components(roots, victims)
+            roots = []
+            for comp in comps:
+                victim = choose(comp)
+                victims.append(victim)
+                roots.extend(tid for tid in comp if tid != victim)
+        self.clear()
+        return victims
+
+
 class Lock(object):
     read = 17
     write = 23
 
-    def __init__(self):
+    def __init__(self, graph=None):
         """
-            _lh stands for 'lock holder' and _q is 'queue'. Both _lh and _q contain
-            tuples of lock type and transaction id (tid). _lh contains transactions
-            holding locks. q contains transactions waiting to get a lock.
+            _holders maps the tid of each lock holder to its lock type, and
+            _readers counts the read holders. The FIFO queue of waiting
+            requests is a doubly linked list from _first to _last, each entry
+            a [lock type, tid, previous entry, next entry] list. _queued maps
+            (lock type, tid) to its entry, so membership and removal from
+            anywhere in the queue are O(1). _qlen is the length of the queue.
+
+            The waits-for edges of the lock are pushed to graph as they
+            change. Each queued request waits for the one before it, and the
+            head of the queue waits for the lock, whose edges in the graph are
+            its holders. This gives the same reachability as an edge to
+            everything ahead of it.
         """
-        self._lh = []
-        self._q = []
+        self._holders = {}
+        self._readers = 0
+        self._first = None
+        self._last = None
+        self._queued = {}
+        self._qlen = 0
+        self._graph = graph
 
-    def add_edges(self, edges):  
+    @property
+    def _lh(self):
         """
-            Read lock detection goes through all variables and adds edges. Returns
-            set of all items in cycle. Adds all keys.
+            Lock holders as (lock type, tid) tuples, in the order they were
+            granted.
         """
-        for _, v in self._lh + self._q:
-            if edges[v] == []:
-                pass
+        return [(type_, tid) for tid, type_ in self._holders.items()]
+
+    def _entries(self):
+        entry = self._first
+        while entry is not None:
+            yield entry
+            entry = entry[3]
+
+    def _link(self, tid, waits_for):
+        if self._graph is not None and tid != waits_for:
+            self._graph.add_edge(tid, waits_for)
+
+    def _unlink(self, tid, waits_for):
+        if self._graph is not None and tid != waits_for:
+            self._graph.remove_edge(tid, waits_for)
+
+    def _grant(self, type_, tid):
+        self._holders[tid] = type_
+        if type_ == Lock.read:
+            self._readers += 1
+        if self._graph is not None and self._first is not None:
+            self._graph.add_holder(self._first[1], tid)
+
+    def _release(self, tid):
+        if self._holders.pop(tid) == Lock.read:
+            self._readers -= 1
+
+    def _enqueue(self, type_, tid, front=False):
+        if front:
+            head = self._first
+            entry = [type_, tid, None, head]
+            if head is None:
+                self._last = entry
+            else:
+                self._unlink(head[1], self)
+                self._link(head[1], tid)
+                head[2] = entry
+            self._link(tid, self)
+            self._first = entry
+        else:
+            tail = self._last
+            entry = [type_, tid, tail, None]
+            if tail is None:
+                self._link(tid, self)
+                self._first = entry
+            else:
+                self._link(tid, tail[1])
+                tail[3] = entry
+            self._last = entry
+        self._queued[(type_, tid)] = entry
+        self._qlen += 1
+
+    def _dequeue(self, key):
+        """
+            Removes a waiting request from anywhere in the queue. Only the
+            edges to and from its neighbours need fixing.
+        """
+        _, tid, prev, next_ = self._queued.pop(key)
+        self._qlen -= 1
+        if prev is None:
+            self._first = next_
+        else:
+            prev[3] = next_
+        if next_ is None:
+            self._last = prev
+        else:
+            next_[2] = prev
+        waits_for = self if prev is None else prev[1]
+        self._unlink(tid, waits_for)
+        if next_ is not None:
+            self._unlink(next_[1], tid)
+            self._link(next_[1], waits_for)
+
+    def _links(self):
+        prev = None
+        for _, tid, _, _ in self._entries():
+            if prev is None:
+                for holder in self._holders:
+                    if holder != tid:
+                        yield tid, holder
+            elif prev != tid:
+                yield tid, prev
+            prev = tid
+
+    def waits(self):
+        """
+            Returns the waits-for edges implied by the queue.
+        """
+        return set(self._links())
 
-        # Anything in q is waiting for transactions before it in the queue and for
-        # transactions holding locks.
-        for i in reversed(range(len(self._q))):
-            # Starts from last index (10 elements, starts at 9)
-            for j in reversed(range(i)):
-                if self._q[i][1] != self._q[j][1]:
-                    edges[self._q[i][1]].add(self._q[j][1])
-            for l in self._lh:
-                if self._q[i][1] != l:
-                    edges[self._q[i][1]].add(l[1])
+    def add_edges(self, edges):
+        """
+            Adds the waits-for edges of this lock to edges, a defaultdict of
+            sets, and returns it.
+        """
+        for tid, waits_for in self.waits():
+            edges[tid].add(waits_for)
         return edges
 
+    # Number of requests waiting for the lock.
+    @property
+    def queue_length(self):
+        return self._qlen
+
+    # True if nobody holds or waits for the lock.
+    @property
+    def idle(self):
+        return not self._holders and self._qlen == 0
+
     # Returns the number of locks held.
     @property
     def held(self):
-        return len(self._lh) > 0
+        return len(self._holders) > 0
 
     # Checks if q and lock holder are empty and if so, gives lock. Also checks
     # if a site is ready to read, meaning q is empty but another transaction is
     # holding the read lock, so a transaction can jump in and get a read lock.
     @property
     def read_ready(self):
-        return self._q == [] and self.held and self._lh[0][0] == Lock.read
+        return self._qlen == 0 and self._readers > 0
 
     # Determines if tid (transaction id) already has a lock or is waiting.
     # Returns true or false. Tries to acquire root lock.
     def rlock(self, tid):
-        if (Lock.read, tid) in self._lh or (Lock.write, tid) in self._lh:
+        if tid in self._holders:
             return True
-        elif (Lock.read, tid) in self._q:
+        elif (Lock.read, tid) in self._queued:
             return False
 
-        if self._q == [] and self._lh == []:
-            self._lh.append((Lock.read, tid))
+        if self._qlen == 0 and not self._holders:
+            self._grant(Lock.read, tid)
             return True
         elif self.read_ready:
-            self._lh.append((Lock.read, tid))
+            self._grant(Lock.read, tid)
             return True
         else: # Only thing in q could be write lock
-            self._q.append((Lock.read, tid))
+            self._enqueue(Lock.read, tid)
             return False
 
     # Does the same as rlock() except for writes.
     def wlock(self, tid):
-        if (Lock.write, tid) in self._lh:
+        if self._holders.get(tid) == Lock.write:
             return True
-        elif (Lock.write, tid) in self._q:
+        elif (Lock.write, tid) in self._queued:
             return False
 
-        if self._q == [] and self._lh == []:
-            self._lh.append((Lock.write, tid))
+        if self._qlen == 0 and not self._holders:
+            self._grant(Lock.write, tid)
             return True
         else:
-            self._q.append((Lock.write, tid))
+            self._enqueue(Lock.write, tid)
             return False
 
     # upgrade() takes a transaction out of lock holders and puts it at front of
@@ -96,72 +440,174 @@ class Lock(object):
     # queue in front of it. An example is if T1 wants to execute R1(x) and W1(x),
     # T2 wants to execute R2(x), and T3 wants to execute W3(x).
     def upgrade(self, tid):
-        if (Lock.write, tid) in self._lh:
+        type_ = self._holders.get(tid)
+        if type_ == Lock.write:
             return True
+        elif type_ is None:
+            raise ValueError('T{} holds no read lock to upgrade'.format(tid))
 
-        self._lh.remove((Lock.read, tid))
+        # A write request already queued by wlock() is replaced by this one
+        if (Lock.write, tid) in self._queued:
+            self._dequeue((Lock.write, tid))
+        self._release(tid)
         if not self.held:
-            self._lh.append((Lock.write, tid))
+            self._grant(Lock.write, tid)
             return True
         else:
-            self._q.insert(0, (Lock.write, tid))
+            self._enqueue(Lock.write, tid, front=True)
             return False
 
     # unlock() notifies whether a transaction can lock a site. It can also unlock a site
     # and remove the tid (transaction id) from lock holders.
     def unlock(self, tid):
-        if (Lock.read, tid) in self._lh:
-            self._lh.remove((Lock.read, tid))
-        if (Lock.write, tid) in self._lh:
-            self._lh.remove((Lock.write, tid))
+        if tid in self._holders:
+            self._release(tid)
 
-        if (Lock.read, tid) in self._q:
-            self._q.remove((Lock.read, tid))
-        if (Lock.write, tid) in self._q:
-            self._q.remove((Lock.write, tid))
+        if (Lock.read, tid) in self._queued:
+            self._dequeue((Lock.read, tid))
+        if (Lock.write, tid) in self._queued:
+            self._dequeue((Lock.write, tid))
 
         to_notify = []
-        if (not self.held) and len(self._q) > 0:
-            first = self._q.pop(0)
-            self._lh.append(first)
-            to_notify.append(first[1])
+        if (not self.held) and self._qlen > 0:
+            # The head is granted, along with every read right behind it if
+            # it is a read. Their edges to each other and to the lock go, and
+            # whoever is left at the head now waits for the lock instead.
+            first = self._first
+            batch = [first]
             if first[0] == Lock.read:
-                while len(self._q) > 0 and self._q[0][0] == Lock.read:
-                    next_ = self._q.pop(0)
-                    self._lh.append(next_)
-                    to_notify.append(next_[1])
+                entry = first[3]
+                while entry is not None and entry[0] == Lock.read:
+                    batch.append(entry)
+                    entry = entry[3]
+            self._unlink(first[1], self)
+            for entry, prev in zip(batch[1:], batch):
+                self._unlink(entry[1], prev[1])
+            for entry in batch:
+                del self._queued[(entry[0], entry[1])]
+            self._qlen -= len(batch)
+            head = self._first = batch[-1][3]
+            if head is None:
+                self._last = None
+            else:
+                head[2] = None
+                self._unlink(head[1], batch[-1][1])
+            for type_, tid, _, _ in batch:
+                self._holders[tid] = type_
+                if type_ == Lock.read:
+                    self._readers += 1
+                to_notify.append(tid)
+            if head is not None:
+                self._link(head[1], self)
         return to_notify
 
+    def leave_q(self, tid):
+        if (Lock.write, tid) not in self._queued:
+            raise ValueError('T{} is not waiting to write'.format(tid))
+        self._dequeue((Lock.write, tid))
+
+    def clear(self):
+        """
+            Drops every holder and waiter, e.g. when the site fails.
+        """
+        if self._graph is not None:
+            waits_for = self
+            for _, tid, _, _ in self._entries():
+                self._unlink(tid, waits_for)
+                waits_for = tid
+        self._holders = {}
+        self._readers = 0
+        self._first = None
+        self._last = None
+        self._queued = {}
+        self._qlen = 0
+
 
 class LockManager(object):
-    def __init__(self, varc):
-        self._lock_q = [Lock() for _ in range(varc)]
+    """
+        Locks are created when a variable is first requested and dropped again
+        once nobody holds or waits for them, so a lock manager only holds the
+        locks of the variables currently in use.
+
+        upgrade_conflicts counts per variable the upgrades that had to wait
+        for other readers. It outlives the locks, and failures.
+    """
+    def __init__(self, varc, graph=None):
+        self._varc = varc
+        self._graph = graph
+        self._lock_q = {}
+        self.upgrade_conflicts = Counter()
+
+    def _lock(self, var):
+        lock = self._lock_q.get(var)
+        if lock is None:
+            if var < 1 or var > self._varc:
+                raise ValueError('Illegal variable {}. Must be between 1 and {}'
+                                 .format(var, self._varc))
+            lock = self._lock_q[var] = Lock(self._graph)
+        return lock
+
+    def _drop_idle(self, var, lock):
+        if lock.idle:
+            del self._lock_q[var]
 
     def rlock(self, var, tid):
-        vindex = var - 1
-        return self._lock_q[vindex].rlock(tid)
+        return self._lock(var).rlock(tid)
 
     def wlock(self, var, tid):
-        vindex = var - 1
-        return self._lock_q[vindex].wlock(tid)
+        return self._lock(var).wlock(tid)
 
     def upgrade(self, var, tid):
-        vindex = var - 1
-        return self._lock_q[vindex].upgrade(tid)
+        upgraded = self._lock(var).upgrade(tid)
+        if not upgraded:
+            self.upgrade_conflicts[var] += 1
+        return upgraded
 
-    def unlock(self, tid):
+    def unlock(self, tid, var=None):
+        """
+            Releases or dequeues tid on the lock of var, or on every lock if
+            var is None. Returns the tids that were granted the lock.
+        """
+        if var is not None:
+            lock = self._lock_q.get(var)
+            if lock is None:
+                return []
+            updates = lock.unlock(tid)
+            self._drop_idle(var, lock)
+            return updates
         updates = []
-        for lock in self._lock_q:
-            updates += lock.unlock(tid)
+        for var in sorted(self._lock_q):
+            updates += self.unlock(tid, var)
         return updates
 
     def leave_q(self, var, tid):
-        self._lock_q[var - 1]._q.remove((Lock.write, tid))
+        lock = self._lock(var)
+        lock.leave_q(tid)
+        self._drop_idle(var, lock)
+
+    def clear(self):
+        for lock in self._lock_q.values():
+            lock.clear()
+        self._lock_q = {}
 
     def dl_detect(self, edges):
-        for lock in self._lock_q:
+        for lock in self._lock_q.values():
             lock.add_edges(edges)
 
+    def queue_lengths(self):
+        """
+            (var, number of waiting requests) of every lock with a queue.
+        """
+        return [(var, lock.queue_length)
+                for var, lock in self._lock_q.items() if lock.queue_length]
+
+    def lock_edges(self):
+        """
+            The waits-for edges of each lock with a queue, by variable.
+        """
+        return {var: lock.add_edges(defaultdict(set))
+                for var, lock in self._lock_q.items() if lock.queue_length}
+
 
 class TestLockManager(unittest.TestCase):
     @classmethod
@@ -178,7 +624,7 @@ class TestLockManager(unittest.TestCase):
         self.assertFalse(self._lm.wlock(1, 3))
         self.assertEqual(self._lm.unlock(1), [])
         self.assertEqual(len(self._lm.unlock(2)), 1)
-        self.assertTrue(self._lm._lock_q[0].held)
+        self.assertTrue(self._lm._lock_q[1].held)
 
     # TODO: Change assertTrue(a == b) into assertEqual(a, b)
     def test_upgrade(self):
@@ -187,11 +633,49 @@ class TestLockManager(unittest.TestCase):
 
         self.assertFalse(self._lm.wlock(1, 3))
         self.assertFalse(self._lm.upgrade(1, 2))
+        self.assertEqual(self._lm.upgrade_conflicts, {1: 1})
 
         self.assertTrue(self._lm.unlock(1) == [2])
-        self.assertTrue(self._lm._lock_q[0]._lh[0] == (Lock.write, 2))
+        self.assertTrue(self._lm._lock_q[1]._lh[0] == (Lock.write, 2))
         self.assertTrue(self._lm.unlock(2) == [3])
-        self.assertTrue(self._lm._lock_q[0]._lh[0] == (Lock.write, 3))
+        self.assertTrue(self._lm._lock_q[1]._lh[0] == (Lock.write, 3))
+
+    def test_dequeue_middle(self):
+        self.assertTrue(self._lm.wlock(1, 1))
+        self.assertFalse(self._lm.rlock(1, 2))
+        self.assertFalse(self._lm.wlock(1, 3))
+        self.assertFalse(self._lm.rlock(1, 4))
+        self.assertEqual(self._lm.unlock(3), [])
+        self.assertEqual(self._lm.unlock(1), [2, 4])
+        self.assertEqual(self._lm._lock_q[1]._readers, 2)
+        self.assertIsNone(self._lm._lock_q[1]._first)
+
+    def test_upgrade_held_alone(self):
+        self.assertTrue(self._lm.rlock(1, 1))
+        self.assertFalse(self._lm.wlock(1, 2))
+        self.assertTrue(self._lm.upgrade(1, 1))
+        self.assertEqual(self._lm._lock_q[1]._lh, [(Lock.write, 1)])
+        with self.assertRaises(ValueError):
+            self._lm.upgrade(1, 2)
+
+    def test_lazy_locks(self):
+        self.assertEqual(self._lm._lock_q, {})
+        self.assertTrue(self._lm.rlock(3, 1))
+        self.assertFalse(self._lm.wlock(3, 2))
+        self.assertEqual(list(self._lm._lock_q), [3])
+        self.assertEqual(self._lm.unlock(1, 3), [2])
+        self.assertEqual(self._lm.unlock(2, 3), [])
+        self.assertEqual(self._lm._lock_q, {})
+        with self.assertRaises(ValueError):
+            self._lm.rlock(21, 1)
+
+    def test_unlock_var(self):
+        self.assertTrue(self._lm.wlock(1, 1))
+        self.assertTrue(self._lm.wlock(2, 1))
+        self.assertFalse(self._lm.wlock(2, 2))
+        self.assertEqual(self._lm.unlock(1, 2), [2])
+        self.assertTrue(self._lm._lock_q[1].held)
+        self.assertEqual(self._lm.unlock(1, 3), [])
 
     # TODO: Change assertTrue(a == b) into assertEqual(a, b)
     def test_read_q(self):
@@ -219,5 +703,112 @@ class TestLockManager(unittest.TestCase):
         self._lm.dl_detect(dd)
         self.assertTrue(len(dd) > 0)
 
+    def test_queues(self):
+        self.assertTrue(self._lm.wlock(1, 1))
+        self.assertTrue(self._lm.rlock(2, 2))
+        self.assertFalse(self._lm.rlock(1, 2))
+        self.assertFalse(self._lm.wlock(1, 3))
+        self.assertEqual(self._lm.queue_lengths(), [(1, 2)])
+        self.assertEqual(self._lm.lock_edges(), {1: {2: {1}, 3: {2}}})
+
+
+class TestWaitsForGraph(unittest.TestCase):
+    def setUp(self):
+        self._g = WaitsForGraph()
+        self._lm = LockManager(20, self._g)
+
+    def test_queue_edges(self):
+        self.assertTrue(self._lm.rlock(1, 1))
+        self.assertTrue(self._lm.rlock(1, 2))
+        self.assertFalse(self._lm.wlock(1, 3))
+        self.assertFalse(self._lm.rlock(1, 4))
+        self.assertEqual(self._g.edges(), {3: {1, 2}, 4: {3}})
+        self.assertEqual(self._g.touched(), [3, 4])
+
+    def test_release(self):
+        self.assertTrue(self._lm.wlock(1, 1))
+        self.assertFalse(self._lm.wlock(1, 2))
+        self.assertFalse(self._lm.wlock(1, 3))
+        self.assertEqual(self._lm.unlock(1), [2])
+        self.assertEqual(self._g.edges(), {3: {2}})
+        self.assertEqual(self._lm.unlock(3), [])
+        self.assertEqual(self._g.edges(), {})
+
+    def test_head_waits_for_lock(self):
+        # The head has one edge, to the lock, whatever the holders do
+        for tid in (1, 2, 3):
+            self.assertTrue(self._lm.rlock(1, tid))
+        self.assertFalse(self._lm.wlock(1, 4))
+        lock = self._lm._lock_q[1]
+        self.assertEqual(dict(self._g[4]), {lock: 1})
+        self.assertEqual(self._g.edges(), {4: {1, 2, 3}})
+        self.assertEqual(self._lm.unlock(1), [])
+        self.assertEqual(dict(self._g[4]), {lock: 1})
+        self.assertEqual(self._g.edges(), {4: {2, 3}})
+        self.assertFalse(self._lm.upgrade(1, 2))
+        self.assertEqual(self._g.edges(), {2: {3}, 4: {2}})
+        self.assertEqual(self._lm.unlock(3), [2])
+        self.assertEqual(self._g.edges(), {4: {2}})
+
+    def test_shared_edge(self):
+        # The same wait on two locks only leaves once both drop it
+        self.assertTrue(self._lm.wlock(1, 1))
+        self.assertTrue(self._lm.wlock(2, 1))
+        self.assertFalse(self._lm.wlock(1, 2))
+        self.assertFalse(self._lm.wlock(2, 2))
+        self._lm.leave_q(1, 2)
+        self.assertTrue((2, 1) in self._g)
+        self._lm.leave_q(2, 2)
+        self.assertFalse((2, 1) in self._g)
+
+    def test_clear(self):
+        self.assertTrue(self._lm.wlock(1, 1))
+        self.assertFalse(self._lm.wlock(1, 2))
+        self._lm.clear()
+        self.assertEqual(len(self._g), 0)
+        self.assertEqual(self._g.touched(), [])
+
+    def test_components(self):
+        for u, v in [(1, 2), (2, 1), (3, 4), (4, 5), (5, 3), (6, 1)]:
+            self._g.add_edge(u, v)
+        comps = self._g.components(self._g.touched())
+        self.assertEqual(sorted(sorted(c) for c in comps), [[1, 2], [3, 4, 5]])
+
+    def test_victims(self):
+        # 1 waits for both 2 and 3 which both wait for 1: two cycles in one
+        # component, each needing its own victim
+        for u, v in [(1, 2), (1, 3), (2, 1), (3, 1)]:
+            self._g.add_edge(u, v)
+        self.assertEqual(self._g.victims(max), [3, 2])
+        self.assertFalse(self._g.changed)
+
+    def test_wait_die(self):
+        g = WaitsForGraph(Prevention.wait_die, timestamp=lambda tid: tid)
+        lm = LockManager(20, g)
+        self.assertTrue(lm.wlock(1, 2))
+        self.assertTrue(lm.wlock(2, 1))
+        # Older T1 waits for T2, younger T2 dies
+        self.assertFalse(lm.wlock(1, 1))
+        self.assertFalse(g.doomed)
+        self.assertFalse(lm.wlock(2, 2))
+        self.assertEqual(g.pop_doomed(), [2])
+
+    def test_wound_wait(self):
+        g = WaitsForGraph(Prevention.wound_wait, timestamp=lambda tid: tid)
+        lm = LockManager(20, g)
+        self.assertTrue(lm.rlock(1, 2))
+        self.assertTrue(lm.rlock(1, 3))
+        # Older T1 wounds both readers, younger T4 then waits for T1
+        self.assertFalse(lm.wlock(1, 1))
+        self.assertEqual(g.pop_doomed(), [2, 3])
+        self.assertFalse(lm.wlock(1, 4))
+        self.assertFalse(g.doomed)
+
+    def test_long_chain(self):
+        n = 10000
+        for tid in range(n):
+            self._g.add_edge(tid, (tid + 1) % n)
+        self.assertEqual(self._g.victims(max), [n - 1])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,211 @@
+"""
+Classes:
+    Read: value read by a transaction.
+    Write: write accepted into the write set of a transaction.
+    Blocked: read or write that has to wait, and why.
+    Commit: transaction that committed.
+    Abort: transaction that aborted, and why.
+    Dump: committed values of the variables of a site.
+    Sink: receives every result of the TransactionManager and writes its
+          text, if any, through write(). The text is the same as the output
+          the project has always printed.
+    PrintSink: prints each line as it comes, the default.
+    BufferedSink: writes the lines to a file in large blocks.
+    NullSink: drops everything.
+    Collector: keeps the results in a list.
+    TestSinks: Unit tests for results and sinks.
+"""
+import io
+import sys
+import unittest
+from collections import namedtuple
+
+
+class Read(namedtuple('Read', ['tid', 'var', 'value', 'version', 'site'])):
+    """
+        site is None when a transaction reads its own write.
+    """
+    __slots__ = ()
+
+    def text(self, full_output=True, log_writes=True):
+        return 'x{}: {}{}'.format(
+            self.var, self.value,
+            ' (T{})'.format(self.tid) if full_output else '')
+
+
+class Write(namedtuple('Write', ['tid', 'var', 'value', 'sites'])):
+    __slots__ = ()
+
+    def text(self, full_output=True, log_writes=True):
+        if full_output and log_writes:
+            return 'x{} = {} (T{})'.format(self.var, self.value, self.tid)
+
+
+class Blocked(namedtuple('Blocked', ['tid', 'var', 'value', 'reason'])):
+    """
+        value is None for a read. reason is 'no site', 'no lock' or
+        'need locks'.
+    """
+    __slots__ = ()
+
+    @property
+    def write(self):
+        return self.value is not None
+
+    def text(self, full_output=True, log_writes=True):
+        if self.write:
+            if full_output and log_writes:
+                return 'T{} blocked writing x{} ({})'.format(
+                    self.tid, self.var, self.reason)
+        elif full_output:
+            return 'T{} blocked reading x{} ({})'.format(
+                self.tid, self.var, self.reason)
+
+
+class Commit(namedtuple('Commit', ['tid'])):
+    __slots__ = ()
+
+    def text(self, full_output=True, log_writes=True):
+        return 'T{} commits'.format(self.tid)
+
+
+class Abort(namedtuple('Abort', ['tid', 'reason'])):
+    __slots__ = ()
+
+    def text(self, full_output=True, log_writes=True):
+        return 'T{} aborts{}'.format(
+            self.tid, ' ({})'.format(self.reason) if full_output else '')
+
+
+class Dump(namedtuple('Dump', ['site', 'values'])):
+    """
+        values is a list of (variable, value).
+    """
+    __slots__ = ()
+
+    def text(self, full_output=True, log_writes=True):
+        if self.values:
+            return 'site {} - {}'.format(self.site, ' '.join(
+                'x{}: {}'.format(var, value) for var, value in self.values))
+
+
+class Sink(object):
+    """
+        full_output and log_writes have the meaning of the TransactionManager
+        arguments of the same name.
+    """
+    def __init__(self, full_output=True, log_writes=True):
+        self._full_output = full_output
+        self._log_writes = log_writes
+
+    def emit(self, result):
+        line = result.text(self._full_output, self._log_writes)
+        if line is not None:
+            self.write(line)
+
+    def write(self, line):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class PrintSink(Sink):
+    """
+        sys.stdout is looked up for every line, so redirecting it works as it
+        does for print().
+    """
+    def write(self, line):
+        print(line)
+
+
+class BufferedSink(Sink):
+    """
+        Writes to out once block_size characters are waiting, and on flush()
+        or close(). With a block_size of 0 every line is written right away.
+    """
+    def __init__(self, out=None, full_output=True, log_writes=True,
+                 block_size=1 << 16):
+        super().__init__(full_output, log_writes)
+        self._out = sys.stdout if out is None else out
+        self._block_size = block_size
+        self._lines = []
+        self._size = 0
+
+    def write(self, line):
+        self._lines.append(line)
+        self._size += len(line) + 1
+        if self._size >= self._block_size:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            self._lines.append('')
+            self._out.write('\n'.join(self._lines))
+            self._lines = []
+            self._size = 0
+        self._out.flush()
+
+
+class NullSink(Sink):
+    def emit(self, result):
+        pass
+
+
+class Collector(Sink):
+    def __init__(self, full_output=True, log_writes=True):
+        super().__init__(full_output, log_writes)
+        self.results = []
+
+    def emit(self, result):
+        self.results.append(result)
+
+    def lines(self):
+        """
+            The text output of the results collected so far.
+        """
+        lines = (r.text(self._full_output, self._log_writes)
+                 for r in self.results)
+        return [line for line in lines if line is not None]
+
+    def clear(self):
+        self.results = []
+
+
+class TestSinks(unittest.TestCase):
+    RESULTS = [Read(1, 2, 20, 0, 1), Write(1, 3, 30, (4,)),
+               Blocked(2, 3, None, 'no lock'), Blocked(2, 4, 5, 'no site'),
+               Commit(1), Abort(2, 'deadlock'), Dump(3, [(2, 20), (4, 40)]),
+               Dump(4, [])]
+
+    def test_text(self):
+        sink = Collector()
+        for result in self.RESULTS:
+            sink.emit(result)
+        self.assertEqual(sink.lines(), [
+            'x2: 20 (T1)', 'x3 = 30 (T1)', 'T2 blocked reading x3 (no lock)',
+            'T2 blocked writing x4 (no site)', 'T1 commits',
+            'T2 aborts (deadlock)', 'site 3 - x2: 20 x4: 40'])
+        sink = Collector(full_output=False)
+        sink.results = self.RESULTS
+        self.assertEqual(sink.lines(), [
+            'x2: 20', 'T1 commits', 'T2 aborts', 'site 3 - x2: 20 x4: 40'])
+
+    def test_buffered(self):
+        out = io.StringIO()
+        sink = BufferedSink(out, block_size=20)
+        sink.emit(Commit(1))
+        self.assertEqual(out.getvalue(), '')
+        sink.emit(Commit(22))
+        self.assertEqual(out.getvalue(), 'T1 commits\nT22 commits\n')
+        sink.emit(Abort(3, 'deadlock'))
+        sink.close()
+        self.assertEqual(out.getvalue().splitlines()[-1],
+                         'T3 aborts (deadlock)')
+
+
+if __name__ == '__main__':
+    unittest.main()
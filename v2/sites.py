@@ -4,44 +4,59 @@ Authors Conrad Christensen and Jane Liu
 Classes:
     Site: where data is actually held in the database. Also holds a lock
           manager for the items.
+    Storage: the storage engines a Site can keep its data in.
+    EntryStore: storage engine made of SiteEntry objects.
+    ColumnStore: storage engine made of arrays indexed by variable slot.
+    ColumnEntry: SiteEntry-like view of a ColumnStore slot.
     SiteEntry: tracks versions of data items for multi version concurrency
                control.
     TestSite: Unit tests for Site and SiteEntry classes
 """
+import enum
 import logging
+import random
 import unittest
+from array import array
+from bisect import bisect_right
 from collections import namedtuple
 
 from .lock_manager import LockManager
+from .topology import Topology
 
 logger = logging.getLogger('txn_manager')
 
 MValue = namedtuple('MValue', ['value', 'version'])
 
+DEFAULT_TOPOLOGY = Topology()
+
 class SiteEntry(object):
     """
         SiteEntry: This class provides a means for tracking versions of DB
             values. It allows failing and refuses reads that are before the
             latest fail point.
 
-            SiteEntry holds 10 or 12 variables all indexed from 1 to 20. Each
-            of those variables may have many versions.
+            With the default topology a site holds 10 or 12 variables all
+            indexed from 1 to 20. Each of those variables may have many
+            versions.
     """
-    def __new__(cls, zindex, sindex):
+    def __new__(cls, zindex, sindex, topology=DEFAULT_TOPOLOGY):
         """
-            Controls object creation. Checks if zindex (variable) should be
-            stored at sindex (site) and create entry if site index is even,
-            or if entry-index mod 10 = site index.
+            Controls object creation. Checks with the topology if zindex
+            (variable) should be stored at sindex (site) and creates the entry
+            only if so.
         """
-        if (zindex+1) % 2 == 1 and (zindex+2) % 10 != sindex:
+        if not topology.hosts(sindex, zindex + 1):
             return None
         else:
             return super().__new__(cls)
 
-    def __init__(self, zindex, sindex):
+    def __init__(self, zindex, sindex, topology=DEFAULT_TOPOLOGY):
         self._index = zindex + 1
         self._sindex = sindex
-        self._values = [MValue(self._index*10, 0)]
+        self._replicated = topology.replicated(self._index)
+        # Versions oldest first, with _values[i] written at _versions[i]
+        self._values = [self._index*10]
+        self._versions = [0]
         self._isfailed = False
         self._fail_version = -1
 
@@ -49,22 +64,27 @@ class SiteEntry(object):
     def version(self):
         if self.failed:
             raise ValueError('Reading from failed site entry')
-        return self._values[0].version
+        return self._versions[-1]
 
     @property
     def value(self):
         if self.failed:
             raise ValueError('Reading from failed site entry')
-        return self._values[0].value
+        return self._values[-1]
 
     @property
     def latest(self):
-        return self._values[0] # Return both value and version
+        # Return both value and version
+        return MValue(self._values[-1], self._versions[-1])
 
     @property
     def failed(self):
         return self._isfailed
 
+    @property
+    def version_count(self):
+        return len(self._versions)
+
     @property
     def failed_at(self, version):
         return self._fail_version >= version
@@ -86,49 +106,370 @@ class SiteEntry(object):
                 ValueError: Raised if no valid version found, or due to past
                             failure
         """
-        ret = None
-        for item in self._values:
-            if item.version <= version:
-                ret = item
-                break
+        i = bisect_right(self._versions, version) - 1
+        ret = None if i < 0 else MValue(self._values[i], self._versions[i])
         if ret is None or ret.version <= self._fail_version:
             raise ValueError('Reading bad value {}'.format(ret))
         return ret # Return both value and version
 
 
+    def collect(self, watermark):
+        """
+            Drops the versions no read at or after watermark can see: all but
+            the newest version at or before it. Returns the number dropped.
+        """
+        drop = bisect_right(self._versions, watermark) - 1
+        if drop > 0:
+            del self._values[:drop]
+            del self._versions[:drop]
+            return drop
+        return 0
+
     def fail(self):
-        if self._index % 2 == 0:
-            self._fail_version = self.version
+        if self._replicated:
+            self._fail_version = self.latest.version
             self._isfailed = True
         # else this is the only copy of the data so failure is irrelevant 
         # as reading is immediately available once the site parent recovers
 
     # TODO: Does this imply committed
     def write(self, new_value, new_version):
-        self._values.insert(0, MValue(new_value, new_version))
+        # Commits come in timestamp order so this is nearly always an append
+        if new_version >= self._versions[-1]:
+            self._values.append(new_value)
+            self._versions.append(new_version)
+        else:
+            i = bisect_right(self._versions, new_version)
+            self._values.insert(i, new_value)
+            self._versions.insert(i, new_version)
         self._isfailed = False
 
 
+class Storage(enum.Enum):
+    """
+        Storage engines of a Site. entries keeps a SiteEntry object per written
+        variable. columnar keeps the latest value, latest version, failed flag
+        and fail version of every hosted variable in arrays indexed by slot,
+        with the older versions kept apart, and only holds int values.
+    """
+    entries = 'entries'
+    columnar = 'columnar'
+
+
+class EntryStore(object):
+    """
+        Only stores SiteEntry objects for the variables written to the site,
+        or handed out by entry(). Any other variable it hosts still has its
+        initial value, which reads get without an entry. _entries_failed
+        records whether the site has failed since, as that also applies to
+        the entries not made yet.
+    """
+    def __init__(self, site_number, topology):
+        self._site_number = site_number
+        self._topology = topology
+        self._db = {}
+        # Variables whose entry may hold more than one version
+        self._history = set()
+        self._entries_failed = False
+
+    def entry(self, var):
+        """
+            Returns the entry of var, or None if this site does not host it.
+            The entry is kept from then on, and as it can be written to
+            directly, the next collect() visits it.
+        """
+        entry = self._db.get(var)
+        if entry is None:
+            entry = SiteEntry(var - 1, self._site_number, self._topology)
+            if entry is None:
+                return None
+            if self._entries_failed:
+                entry.fail()
+            self._db[var] = entry
+        self._history.add(var)
+        return entry
+
+    def _check_hosted(self, var):
+        if not self._topology.hosts(self._site_number, var):
+            raise KeyError('x{} is not stored at site {}'.format(
+                var, self._site_number))
+
+    def _unwritten(self, var):
+        """
+            Initial value of var. Raises KeyError if var is not hosted here.
+        """
+        self._check_hosted(var)
+        return MValue(var * 10, 0)
+
+    def latest(self, var):
+        entry = self._db.get(var)
+        if entry is not None:
+            return entry.latest
+        return self._unwritten(var)
+
+    def read_atbefore(self, var, version):
+        entry = self._db.get(var)
+        if entry is not None:
+            return entry.read_atbefore(version)
+        mval = self._unwritten(var)
+        if self.stale(var):
+            raise ValueError('Reading bad value {}'.format(mval))
+        return mval
+
+    def stale(self, var):
+        entry = self._db.get(var)
+        if entry is not None:
+            return entry.failed
+        self._check_hosted(var)
+        return self._entries_failed and self._topology.replicated(var)
+
+    def values(self):
+        db = self._db
+        return [(var, db[var]._values[-1] if var in db else var * 10)
+                for var in self._topology.hosted(self._site_number)]
+
+    def write(self, var, value, version):
+        self._check_hosted(var)
+        self.entry(var).write(value, version)
+
+    def collect(self, watermark):
+        """
+            Only entries with more than one version are visited.
+        """
+        dropped = 0
+        for var in list(self._history):
+            entry = self._db[var]
+            dropped += entry.collect(watermark)
+            if entry.version_count == 1:
+                self._history.discard(var)
+        return dropped
+
+    def fail(self):
+        self._entries_failed = True
+        for entry in self._db.values():
+            entry.fail()
+
+
+class ColumnStore(object):
+    """
+        Keeps every hosted variable in a slot of four columns: _values and
+        _versions hold the latest version, _failed and _fail_versions what
+        SiteEntry keeps in _isfailed and _fail_version. Replicated variables
+        take the first _nrep slots, so failing the site is a slice copy.
+
+        Older versions only exist for variables written more than once since
+        the last collection. They are kept in _history as a pair of arrays
+        (versions, values), oldest first, by slot.
+    """
+    def __init__(self, site_number, topology):
+        hosted = topology.hosted(site_number)
+        replicated = [v for v in hosted if topology.replicated(v)]
+        order = replicated + [v for v in hosted if not topology.replicated(v)]
+        n = len(order)
+        self._site_number = site_number
+        self._nrep = len(replicated)
+        # Slot of every variable, -1 if not hosted here
+        self._slot = array('i', [-1]) * (topology.varc + 1)
+        for slot, var in enumerate(order):
+            self._slot[var] = slot
+        self._hosted = hosted
+        # Slots of the hosted variables in increasing variable order
+        self._var_slots = array('i', [self._slot[v] for v in hosted])
+        self._values = array('q', [v * 10 for v in order])
+        self._versions = array('q', [0]) * n
+        self._failed = bytearray(n)
+        self._fail_versions = array('q', [-1]) * n
+        self._history = {}
+
+    def _unhosted(self, var):
+        """
+            Error for var, which has slot -1 as it is not hosted here. It is
+            raised like EntryStore does rather than reading slot -1.
+        """
+        return KeyError('x{} is not stored at site {}'.format(
+            var, self._site_number))
+
+    def entry(self, var):
+        slot = self._slot[var]
+        return None if slot < 0 else ColumnEntry(self, var, slot)
+
+    def latest(self, var):
+        slot = self._slot[var]
+        if slot < 0:
+            raise self._unhosted(var)
+        return MValue(self._values[slot], self._versions[slot])
+
+    def read_atbefore(self, var, version):
+        """
+            Same as SiteEntry.read_atbefore, looking at the history only if
+            the latest version is too new.
+        """
+        slot = self._slot[var]
+        if slot < 0:
+            raise self._unhosted(var)
+        if self._versions[slot] <= version:
+            ret = MValue(self._values[slot], self._versions[slot])
+        else:
+            ret = None
+            hist = self._history.get(slot)
+            if hist is not None:
+                i = bisect_right(hist[0], version) - 1
+                if i >= 0:
+                    ret = MValue(hist[1][i], hist[0][i])
+        if ret is None or ret.version <= self._fail_versions[slot]:
+            raise ValueError('Reading bad value {}'.format(ret))
+        return ret
+
+    def stale(self, var):
+        slot = self._slot[var]
+        if slot < 0:
+            raise self._unhosted(var)
+        return self._failed[slot] == 1
+
+    def values(self):
+        return list(zip(self._hosted,
+                        map(self._values.__getitem__, self._var_slots)))
+
+    def version_count(self, slot):
+        hist = self._history.get(slot)
+        return 1 if hist is None else len(hist[0]) + 1
+
+    def write(self, var, value, version):
+        slot = self._slot[var]
+        if slot < 0:
+            raise self._unhosted(var)
+        hist = self._history.get(slot)
+        if hist is None:
+            hist = self._history[slot] = (array('q'), array('q'))
+        if version >= self._versions[slot]:
+            hist[0].append(self._versions[slot])
+            hist[1].append(self._values[slot])
+            self._values[slot] = value
+            self._versions[slot] = version
+        else:
+            i = bisect_right(hist[0], version)
+            hist[0].insert(i, version)
+            hist[1].insert(i, value)
+        self._failed[slot] = 0
+
+    def collect(self, watermark):
+        dropped = 0
+        for slot, (versions, values) in list(self._history.items()):
+            if self._versions[slot] <= watermark:
+                drop = len(versions)
+            else:
+                drop = bisect_right(versions, watermark) - 1
+            if drop > 0:
+                del versions[:drop]
+                del values[:drop]
+                dropped += drop
+            if not versions:
+                del self._history[slot]
+        return dropped
+
+    def fail(self):
+        # Non replicated copies are the only ones, so their failure is
+        # irrelevant, as for SiteEntry
+        n = self._nrep
+        self._fail_versions[:n] = self._versions[:n]
+        self._failed[:n] = b'\x01' * n
+
+
+class ColumnEntry(object):
+    """
+        View of one slot of a ColumnStore with the interface of SiteEntry, as
+        returned by Site.__getitem__ and bypass_failed.
+    """
+    __slots__ = ('_store', '_var', '_slot')
+
+    def __init__(self, store, var, slot):
+        self._store = store
+        self._var = var
+        self._slot = slot
+
+    @property
+    def failed(self):
+        return self._store._failed[self._slot] == 1
+
+    @property
+    def latest(self):
+        return MValue(self._store._values[self._slot],
+                      self._store._versions[self._slot])
+
+    @property
+    def version(self):
+        if self.failed:
+            raise ValueError('Reading from failed site entry')
+        return self._store._versions[self._slot]
+
+    @property
+    def value(self):
+        if self.failed:
+            raise ValueError('Reading from failed site entry')
+        return self._store._values[self._slot]
+
+    @property
+    def version_count(self):
+        return self._store.version_count(self._slot)
+
+    def read_atbefore(self, version):
+        return self._store.read_atbefore(self._var, version)
+
+    def write(self, new_value, new_version):
+        self._store.write(self._var, new_value, new_version)
+
+
 class Site(object):
-    def __init__(self, site_number):
+    """
+        A site keeps the versions of the variables it hosts in a storage
+        engine chosen by storage (see Storage), next to a lock manager. Both
+        engines answer the same questions, so the site only adds locking and
+        the failed state of the whole site on top.
+    """
+    def __init__(self, site_number, graph=None, topology=DEFAULT_TOPOLOGY,
+                 storage=None):
         # Simpler to do this here
         self._site_number = site_number + 1
-        self._db = [SiteEntry(i, self._site_number) for i in range(20)]
-        self._lm = LockManager(20)
+        self._topology = topology
+        self._varc = topology.varc
+        if storage is Storage.columnar:
+            self._store = ColumnStore(self._site_number, topology)
+        else:
+            self._store = EntryStore(self._site_number, topology)
+        self._lm = LockManager(self._varc, graph)
         self._isfailed = False
 
     def __getitem__(self, index):
-        if index - 1 < 0 or index > len(self._db):
-            raise ValueError('Illegal index {}. Must be between 1 and 20'
-                             .format(index))
+        if index - 1 < 0 or index > self._varc:
+            raise ValueError('Illegal index {}. Must be between 1 and {}'
+                             .format(index, self._varc))
         if self._isfailed:
             raise AttributeError('Cannot access from failed DB')
 
-        return self._db[index - 1]
+        return self._store.entry(index)
 
     def __setitem__(self, *args):
         raise AttributeError('Not allowed')
 
+    def stale(self, var):
+        """
+            True if the copy of var here is a replicated one that has not been
+            written since the site failed, so it cannot be read yet.
+        """
+        return self._store.stale(var)
+
+    def readable_at(self, var, version):
+        """
+            True if the copy of var here can be read as of version, i.e. the
+            site did not fail between the write of the version before it and
+            that version.
+        """
+        try:
+            self._store.read_atbefore(var, version)
+        except ValueError:
+            return False
+        return True
+
     def bypass_failed(self, index):
         """
             Sets is_failed to false before reading.
@@ -139,8 +480,15 @@ class Site(object):
         self._isfailed = fail_state
         return ret
 
-    def unlock(self, tid):
-        return self._lm.unlock(tid)
+    def values(self):
+        """
+            (variable, latest value) of every hosted variable in increasing
+            order, whether the site or its copies failed or not.
+        """
+        return self._store.values()
+
+    def unlock(self, tid, var=None):
+        return self._lm.unlock(tid, var)
 
     def read(self, var, txn):
         """
@@ -149,17 +497,18 @@ class Site(object):
             less than or equal to the read-only version are read.
         """
         if txn.read_only:
-            mval = self[var].read_atbefore(txn.timestamp)
+            mval = self._store.read_atbefore(var, txn.timestamp)
         else:
             if not txn.has_rlock(self._site_number, var):
+                txn.add_lock_request(self._site_number, var)
                 locked = self._lm.rlock(var, txn.tid)
                 if locked:
                     txn.add_rlock(self._site_number, var)
-                    mval = self[var].latest 
+                    mval = self._store.latest(var)
                 else:
                     mval = None
             else:
-                mval = self[var].latest
+                mval = self._store.latest(var)
 
         return mval
 
@@ -168,8 +517,13 @@ class Site(object):
             Attempts to acquire write lock, and enqueues if fails
         """
         if not txn.has_wlock(self._site_number, var):
+            txn.add_lock_request(self._site_number, var)
             if txn.has_rlock(self._site_number, var):
                 locked = self._lm.upgrade(var, txn.tid)
+                if not locked:
+                    # The read lock was given up to queue the upgrade, which
+                    # is now an ordinary write request
+                    txn.remove_rlock(self._site_number, var)
             else:
                 locked = self._lm.wlock(var, txn.tid)
                 if locked:
@@ -179,20 +533,25 @@ class Site(object):
         return locked
 
     def write(self, var, value, timestep):
-        self[var].write(value, timestep)
+        self._store.write(var, value, timestep)
+
+    def collect(self, watermark):
+        """
+            Trims the version chains of this site below watermark. Returns the
+            number of versions dropped.
+        """
+        return self._store.collect(watermark)
 
     @property
     def failed(self):
         return self._isfailed
 
     def fail(self):
-        # TODO: Consider a drop-all method for the _lm instead of just creating
-        # a new lock manager
-        self._lm = LockManager(20)
+        # All locks are lost, which also takes their edges out of the
+        # waits-for graph
+        self._lm.clear()
         self._isfailed = True
-        for entry in self._db:
-            if entry:
-                entry.fail()
+        self._store.fail()
 
     def recover(self):
         self._isfailed = False
@@ -200,6 +559,16 @@ class Site(object):
     def dl_detect(self, edges):
         return self._lm.dl_detect(edges)
 
+    @property
+    def upgrade_conflicts(self):
+        return self._lm.upgrade_conflicts
+
+    def queue_lengths(self):
+        return self._lm.queue_lengths()
+
+    def lock_edges(self):
+        return self._lm.lock_edges()
+
 
 class TestSite(unittest.TestCase):
     def setUp(self):
@@ -220,6 +589,170 @@ class TestSite(unittest.TestCase):
         self.assertTrue(self._site2[13] is None)
         self.assertTrue(self._site2[15] is None)
 
+    def test_lazy_entries(self):
+        self.assertEqual(self._site2._store._db, {})
+        self._site2.write(2, 21, 5)
+        self.assertEqual(list(self._site2._store._db), [2])
+        self.assertEqual(self._site2[2].latest, MValue(21, 5))
+        self.assertEqual(self._site2[4].latest, MValue(40, 0))
+
+    def test_unwritten_reads(self):
+        store = self._site2._store
+        self.assertEqual(store.latest(4), MValue(40, 0))
+        self.assertEqual(store.read_atbefore(4, 3), MValue(40, 0))
+        self.assertFalse(store.stale(4))
+        self.assertEqual(store._db, {})
+        with self.assertRaises(KeyError):
+            store.latest(3)
+        self._site2.fail()
+        self._site2.recover()
+        self.assertEqual(store.latest(4), MValue(40, 0))
+        with self.assertRaises(ValueError):
+            store.read_atbefore(4, 3)
+        self.assertEqual(store.read_atbefore(11, 3), MValue(110, 0))
+        self.assertEqual(store._db, {})
+
+    def test_topology(self):
+        site = Site(2, topology=Topology(4, 8, lambda var, sitec: [3]))
+        self.assertTrue(site[1] is not None)
+        self.assertFalse(site[8].failed)
+        site.fail()
+        self.assertFalse(site.bypass_failed(8).failed)
+        with self.assertRaises(ValueError):
+            site.bypass_failed(9)
+
+    def test_versions(self):
+        for version in range(5, 50, 5):
+            self._site2[2].write(version * 2, version)
+        self._site2[2].write(-1, 12)
+        entry = self._site2[2]
+        self.assertEqual(entry.latest, MValue(90, 45))
+        self.assertEqual(entry.read_atbefore(4), MValue(20, 0))
+        self.assertEqual(entry.read_atbefore(12), MValue(-1, 12))
+        self.assertEqual(entry.read_atbefore(14), MValue(-1, 12))
+        self.assertEqual(entry.read_atbefore(100), MValue(90, 45))
+        self._site2[2].fail()
+        self._site2[2].write(100, 50)
+        self.assertEqual(self._site2[2].read_atbefore(50), MValue(100, 50))
+        with self.assertRaises(ValueError):
+            self._site2[2].read_atbefore(49)
+        self.assertEqual(self._site2.collect(45), 10)
+        self.assertEqual(self._site2[2].version_count, 2)
+
+    def test_entry_writes(self):
+        # Writes through an entry stick, with either storage engine
+        for storage in Storage:
+            site = Site(1, storage=storage)
+            site[2].write(99, 5)
+            self.assertEqual(site[2].latest, MValue(99, 5))
+            self.assertEqual(dict(site.values())[2], 99)
+
+    def test_collect(self):
+        for version in range(1, 6):
+            self._site2.write(2, version * 10, version)
+        self._site2.write(4, 41, 2)
+        self.assertEqual(self._site2.collect(3), 3 + 1)
+        self.assertEqual(self._site2[2].read_atbefore(3), MValue(30, 3))
+        self.assertEqual(self._site2._store._history, {2})
+        self.assertEqual(self._site2.collect(10), 2)
+        self.assertEqual(self._site2._store._history, set())
+        self.assertEqual(self._site2[2].version_count, 1)
+
+    def test_stale(self):
+        self._site2.write(2, 21, 5)
+        self._site2.fail()
+        self._site2.recover()
+        self.assertTrue(self._site2.stale(2))
+        self.assertTrue(self._site2.stale(4))
+        self.assertFalse(self._site2.stale(1))
+        self._site2.write(4, 41, 6)
+        self.assertFalse(self._site2.stale(4))
+
+    def test_fail_unwritten(self):
+        self._site2.fail()
+        self._site2.fail()
+        self._site2.recover()
+        self.assertTrue(self._site2[4].failed)
+        self.assertFalse(self._site2[11].failed)
+        self._site2.write(4, 41, 5)
+        self.assertFalse(self._site2[4].failed)
+        self.assertTrue(self._site2[6].failed)
+
+
+class TestColumnStore(unittest.TestCase):
+    def setUp(self):
+        self._site = Site(1, storage=Storage.columnar)
+
+    def test_layout(self):
+        store = self._site._store
+        self.assertEqual(store._nrep, 10)
+        self.assertEqual(store._slot[1], 10)
+        self.assertEqual(store._slot[2], 0)
+        self.assertEqual(store._slot[3], -1)
+        self.assertTrue(self._site[3] is None)
+        self.assertEqual(self._site[11].latest, MValue(110, 0))
+
+    def test_fail(self):
+        self._site.write(2, 21, 5)
+        self._site.fail()
+        self._site.recover()
+        self.assertTrue(self._site.stale(2))
+        self.assertTrue(self._site[4].failed)
+        self.assertFalse(self._site.stale(11))
+        with self.assertRaises(ValueError):
+            self._site[2].read_atbefore(5)
+        self._site.write(4, 41, 6)
+        self.assertFalse(self._site.stale(4))
+        self.assertEqual(self._site[4].read_atbefore(6), MValue(41, 6))
+
+    def test_unhosted(self):
+        entries = Site(1)._store
+        columns = self._site._store
+        for store in (entries, columns):
+            self.assertIsNone(store.entry(3))
+            with self.assertRaises(KeyError):
+                store.latest(3)
+            with self.assertRaises(KeyError):
+                store.read_atbefore(3, 1)
+            with self.assertRaises(KeyError):
+                store.stale(3)
+            with self.assertRaises(KeyError):
+                store.write(3, 31, 1)
+        # The last slot, which an unchecked -1 would have read, is untouched
+        self.assertEqual(columns.latest(11), entries.latest(11))
+        self.assertEqual(columns.values(), entries.values())
+
+    def test_same_as_entries(self):
+        rand = random.Random(7)
+        entries = Site(1)
+        for ts in range(1, 300):
+            op = rand.random()
+            var = rand.choice((1, 2, 4, 11, 20))
+            if op < 0.6:
+                version = ts - rand.randrange(3)
+                for site in (entries, self._site):
+                    site.write(var, ts, version)
+            elif op < 0.65:
+                for site in (entries, self._site):
+                    site.fail()
+                    site.recover()
+            elif op < 0.7:
+                watermark = ts - rand.randrange(20)
+                self.assertEqual(entries.collect(watermark),
+                                 self._site.collect(watermark))
+            else:
+                results = []
+                for site in (entries, self._site):
+                    try:
+                        results.append(site[var].read_atbefore(ts - 5))
+                    except ValueError:
+                        results.append(None)
+                self.assertEqual(results[0], results[1])
+            self.assertEqual(entries.stale(var), self._site.stale(var))
+            self.assertEqual(entries[var].version_count,
+                             self._site[var].version_count)
+        self.assertEqual(entries.values(), self._site.values())
+
 
 if __name__ == '__main__':
     unittest.main()
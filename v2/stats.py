@@ -0,0 +1,411 @@
+"""
+Classes:
+    Histogram: counts of durations in power of two buckets of microseconds.
+    Stats: what a TransactionManager given one records about its run: the
+           latency of every operation, the time each transaction spent
+           blocked on locks and on failed sites, its retries and outcome,
+           the time taken by each deadlock detection and the abort reasons.
+    Contention: which variables and locks a TransactionManager given one
+                waits for the most, to find the hot keys of a trace.
+    TestStats: Unit tests for Histogram and Stats.
+    TestContention: Unit tests for Contention.
+
+A TransactionManager without Stats or Contention records nothing and only
+pays for a check of None in the few places it would.
+"""
+import io
+import json
+import unittest
+from collections import Counter
+from time import perf_counter_ns
+
+
+class Histogram(object):
+    """
+        Bucket k holds the durations from 2 ** (k - 1) up to 2 ** k
+        microseconds, bucket 0 those under a microsecond.
+    """
+    def __init__(self):
+        self._buckets = Counter()
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, ns):
+        self._buckets[(ns // 1000).bit_length()] += 1
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_us': self.total_ns / 1000,
+            'mean_us': self.total_ns / self.count / 1000 if self.count else 0,
+            'max_us': self.max_ns / 1000,
+            'buckets': {'<{}us'.format(1 << k): self._buckets[k]
+                        for k in sorted(self._buckets)},
+        }
+
+
+class Stats(object):
+    """
+        Blocked times are counted in ticks of the TransactionManager, from
+        the tick an access starts waiting to the one it stops: when it is
+        retried or its transaction finishes. Accesses waiting for a lock and
+        those waiting for a site to recover or a recovered copy to be written
+        are counted apart.
+
+        Operations are timed one histogram per name. Those run by another
+        one, as when unblocked accesses are retried or deadlock victims
+        aborted, go to histograms of their own under nested_operations, and
+        are part of the time of the operation they run in too.
+    """
+    def __init__(self):
+        self._ops = {}
+        self._nested = {}
+        self._depth = 0
+        self._detect = Histogram()
+        self._aborts = Counter()
+        self._txns = {}
+        # Tick each waiting access started waiting, and what for
+        self._waiting = {}
+
+    def time(self, name, method, *args, **kwargs):
+        """
+            Returns method(*args, **kwargs), timed into the histogram of
+            name, or its nested one if another operation is being timed.
+        """
+        ops = self._nested if self._depth else self._ops
+        histogram = ops.get(name)
+        if histogram is None:
+            histogram = ops[name] = Histogram()
+        self._depth += 1
+        start = perf_counter_ns()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            histogram.add(perf_counter_ns() - start)
+            self._depth -= 1
+
+    def _txn(self, tid):
+        txn = self._txns.get(tid)
+        if txn is None:
+            txn = self._txns[tid] = {'lock_wait_ticks': 0,
+                                     'site_wait_ticks': 0, 'retries': 0,
+                                     'outcome': None}
+        return txn
+
+    def wait(self, blocked, kind, tick):
+        """
+            kind is 'lock' or 'site'.
+        """
+        self._waiting.setdefault(blocked, (tick, kind))
+
+    def unwait(self, blocked, tick):
+        since, kind = self._waiting.pop(blocked)
+        self._txn(blocked[0])[kind + '_wait_ticks'] += tick - since
+
+    def retry(self, tid):
+        self._txn(tid)['retries'] += 1
+
+    def detected(self, ns):
+        self._detect.add(ns)
+
+    def finish(self, tid, abort_reason=None):
+        """
+            abort_reason is None for a commit.
+        """
+        if abort_reason is None:
+            self._txn(tid)['outcome'] = 'commit'
+        else:
+            self._txn(tid)['outcome'] = 'abort'
+            self._aborts[abort_reason] += 1
+
+    def as_dict(self):
+        txns = self._txns.values()
+        return {
+            'operations': {name: h.as_dict() for name, h in self._ops.items()},
+            'nested_operations': {name: h.as_dict()
+                                  for name, h in self._nested.items()},
+            'deadlock_detection': self._detect.as_dict(),
+            'aborts': dict(self._aborts),
+            'blocked': {
+                'lock_wait_ticks': sum(t['lock_wait_ticks'] for t in txns),
+                'site_wait_ticks': sum(t['site_wait_ticks'] for t in txns),
+                'retries': sum(t['retries'] for t in txns),
+            },
+            'transactions': {'T{}'.format(tid): txn
+                             for tid, txn in self._txns.items()},
+        }
+
+    def dump(self, out):
+        json.dump(self.as_dict(), out, indent=2)
+        out.write('\n')
+
+
+class Contention(object):
+    """
+        The locks, a variable at a site, have their queue length sampled at
+        every tick of the TransactionManager. The samples add up to the
+        ticks requests spent queued there, and each change is kept as the
+        queue length over time. Per variable, the ticks accesses were blocked
+        on its locks are counted once however many copies they wait for.
+
+        A deadlock cycle involves the variables whose locks give an edge
+        between two of its transactions. Upgrades that had to wait are
+        counted by the lock managers of the sites.
+    """
+    def __init__(self):
+        self._db = None
+        self._ticks = 0
+        self._cycles = 0
+        # (site, var) -> queued ticks, longest queue, cycles and the
+        # (tick, length) changes of its queue
+        self._locks = {}
+        # var -> ticks accesses waited for its locks and cycles
+        self._vars = {}
+        self._lengths = {}
+        self._waiting = {}
+
+    def watch(self, db):
+        """
+            Watches the locks of the sites of the Database db.
+        """
+        self._db = db
+
+    def _lock(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = {'queued_ticks': 0, 'max_queue': 0,
+                                       'cycles': 0, 'queue': []}
+        return lock
+
+    def _var(self, var):
+        stats = self._vars.get(var)
+        if stats is None:
+            stats = self._vars[var] = {'wait_ticks': 0, 'cycles': 0}
+        return stats
+
+    def sample(self, tick):
+        self._ticks += 1
+        lengths = {}
+        for site in self._db.topology.sites:
+            for var, length in self._db[site].queue_lengths():
+                lengths[(site, var)] = length
+        for key, length in lengths.items():
+            lock = self._lock(key)
+            lock['queued_ticks'] += length
+            if length > lock['max_queue']:
+                lock['max_queue'] = length
+            if self._lengths.get(key) != length:
+                lock['queue'].append((tick, length))
+        for key in self._lengths:
+            if key not in lengths:
+                self._locks[key]['queue'].append((tick, 0))
+        self._lengths = lengths
+
+    def wait(self, blocked, tick):
+        self._waiting.setdefault(blocked, tick)
+
+    def unwait(self, blocked, tick):
+        since = self._waiting.pop(blocked, None)
+        if since is not None:
+            self._var(blocked[1])['wait_ticks'] += tick - since
+
+    def cycle(self, comp):
+        """
+            Counts the deadlock cycle of the transactions of comp against
+            the variables involved.
+        """
+        self._cycles += 1
+        members = set(comp)
+        involved = set()
+        for site in self._db.topology.sites:
+            for var, edges in self._db[site].lock_edges().items():
+                if any(waits_for in members
+                       for tid in members.intersection(edges)
+                       for waits_for in edges[tid]):
+                    self._lock((site, var))['cycles'] += 1
+                    involved.add(var)
+        for var in involved:
+            self._var(var)['cycles'] += 1
+
+    def _rows(self):
+        """
+            Rows of the variables and of the locks, keyed by var and by
+            (site, var), with every count they have.
+        """
+        conflicts = {site: self._db[site].upgrade_conflicts
+                     for site in self._db.topology.sites}
+        locks = {}
+        for (site, var), lock in self._locks.items():
+            locks[(site, var)] = dict(
+                lock, upgrade_conflicts=conflicts[site][var],
+                mean_queue=(lock['queued_ticks'] / self._ticks
+                            if self._ticks else 0.0))
+        for site, counts in conflicts.items():
+            for var, count in counts.items():
+                if (site, var) not in locks:
+                    locks[(site, var)] = dict(
+                        self._lock((site, var)), upgrade_conflicts=count,
+                        mean_queue=0.0)
+        variables = {}
+        for (site, var), lock in locks.items():
+            row = variables.get(var)
+            if row is None:
+                row = variables[var] = dict(self._var(var), max_queue=0,
+                                            upgrade_conflicts=0)
+            row['max_queue'] = max(row['max_queue'], lock['max_queue'])
+            row['upgrade_conflicts'] += lock['upgrade_conflicts']
+        for var in self._vars:
+            if var not in variables:
+                variables[var] = dict(self._vars[var], max_queue=0,
+                                      upgrade_conflicts=0)
+        return variables, locks
+
+    def as_dict(self):
+        variables, locks = self._rows()
+        by_site = {}
+        for (site, var), lock in sorted(locks.items()):
+            by_site.setdefault('site {}'.format(site), {})[
+                'x{}'.format(var)] = lock
+        return {
+            'ticks': self._ticks,
+            'cycles': self._cycles,
+            'variables': {'x{}'.format(var): row
+                          for var, row in sorted(variables.items())},
+            'locks': by_site,
+        }
+
+    def report(self, out, top=10):
+        """
+            Writes tables of the top variables, by the ticks accesses waited
+            for them, and of the top locks, by the ticks requests were queued
+            there.
+        """
+        variables, locks = self._rows()
+        rank = lambda ticks: lambda item: (
+            -item[1][ticks], -item[1]['cycles'],
+            -item[1]['upgrade_conflicts'], -item[1]['max_queue'], item[0])
+        out.write('Contention over {} ticks, {} deadlock cycles\n'.format(
+            self._ticks, self._cycles))
+        out.write('{:<14} {:>12} {:>10} {:>10} {:>10}\n'.format(
+            'variable', 'wait ticks', 'max queue', 'upgrades', 'cycles'))
+        for var, row in sorted(variables.items(),
+                               key=rank('wait_ticks'))[:top]:
+            out.write('{:<14} {:>12} {:>10} {:>10} {:>10}\n'.format(
+                'x{}'.format(var), row['wait_ticks'], row['max_queue'],
+                row['upgrade_conflicts'], row['cycles']))
+        out.write('{:<14} {:>12} {:>10} {:>10} {:>10} {:>10}\n'.format(
+            'lock', 'queued ticks', 'mean queue', 'max queue', 'upgrades',
+            'cycles'))
+        for (site, var), row in sorted(locks.items(),
+                                       key=rank('queued_ticks'))[:top]:
+            out.write('{:<14} {:>12} {:>10.2f} {:>10} {:>10} {:>10}\n'.format(
+                'x{} site {}'.format(var, site), row['queued_ticks'],
+                row['mean_queue'], row['max_queue'],
+                row['upgrade_conflicts'], row['cycles']))
+
+
+class TestStats(unittest.TestCase):
+    def test_histogram(self):
+        h = Histogram()
+        for ns in (10, 999, 1000, 1999, 2000, 5000000):
+            h.add(ns)
+        d = h.as_dict()
+        self.assertEqual(d['buckets'], {'<1us': 2, '<2us': 2, '<4us': 1,
+                                        '<8192us': 1})
+        self.assertEqual((d['count'], d['max_us']), (6, 5000))
+
+    def test_time(self):
+        stats = Stats()
+        inner = lambda: stats.time('inner', lambda x: x, 1)
+        self.assertEqual(stats.time('outer', lambda: inner() + 1), 2)
+        self.assertEqual(inner(), 1)
+        d = stats.as_dict()
+        ops, nested = d['operations'], d['nested_operations']
+        self.assertEqual((ops['outer']['count'], ops['inner']['count']),
+                         (1, 1))
+        self.assertEqual(list(nested), ['inner'])
+        self.assertEqual(nested['inner']['count'], 1)
+
+    def test_transaction_manager(self):
+        from .results import NullSink
+        from .transaction_manager import TransactionManager
+        stats = Stats()
+        tm = TransactionManager(sink=NullSink(), stats=stats)
+        for tid in (1, 2, 3):
+            tm.new_txn(tid)
+        tm.write(1, 2, 21)
+        tm.read(2, 2)
+        tm.fail(4)
+        tm.read(3, 3)
+        tm.finish_txn(1)
+        tm.recover(4)
+        tm.finish_txn(2)
+        tm.finish_txn(3)
+        d = stats.as_dict()
+        self.assertEqual(d['operations']['read']['count'], 2)
+        self.assertEqual(d['operations']['finish_txn']['count'], 3)
+        # The reads of T2 and T3 are retried by T1's abort and the recovery
+        self.assertEqual(list(d['nested_operations']), ['read'])
+        self.assertEqual(d['nested_operations']['read']['count'], 2)
+        self.assertEqual(d['aborts'], {'site 4 failure': 1})
+        # T2 waits for the lock of T1 from tick 5 to its abort at tick 8,
+        # T3 for site 4 from tick 6 (failing does not tick) to its recovery
+        # at tick 9
+        self.assertEqual(d['transactions']['T2'],
+                         {'lock_wait_ticks': 3, 'site_wait_ticks': 0,
+                          'retries': 1, 'outcome': 'commit'})
+        self.assertEqual(d['transactions']['T3'],
+                         {'lock_wait_ticks': 0, 'site_wait_ticks': 3,
+                          'retries': 0, 'outcome': 'commit'})
+        self.assertEqual(d['transactions']['T1']['outcome'], 'abort')
+        self.assertEqual(d['deadlock_detection']['count'], tm.time - 1)
+
+
+class TestContention(unittest.TestCase):
+    def setUp(self):
+        from .results import NullSink
+        from .transaction_manager import TransactionManager
+        self._contention = Contention()
+        self._tm = TransactionManager(sink=NullSink(),
+                                      contention=self._contention)
+
+    def test_deadlock_and_upgrade(self):
+        tm = self._tm
+        for tid in (1, 2, 3, 4):
+            tm.new_txn(tid)
+        # T1 and T2 deadlock over x1 (site 2) and x2 (every site)
+        tm.write(1, 1, 10)
+        tm.write(2, 2, 20)
+        tm.write(1, 2, 11)
+        tm.write(2, 1, 21)
+        # T3 has to wait for T4 to upgrade its read lock on x3 (site 4)
+        tm.read(3, 3)
+        tm.read(4, 3)
+        tm.write(3, 3, 30)
+        tm.finish_txn(4)
+        d = self._contention.as_dict()
+        self.assertEqual((d['ticks'], d['cycles']), (tm.time - 1, 1))
+        self.assertEqual(d['variables']['x1'],
+                         {'wait_ticks': 1, 'cycles': 1, 'max_queue': 1,
+                          'upgrade_conflicts': 0})
+        self.assertEqual(d['variables']['x3']['upgrade_conflicts'], 1)
+        self.assertEqual(len(d['locks']), 10)
+        x2 = d['locks']['site 7']['x2']
+        self.assertEqual((x2['queued_ticks'], x2['cycles']), (2, 1))
+        self.assertEqual(x2['queue'], [(8, 1), (10, 0)])
+
+        out = io.StringIO()
+        self._contention.report(out, top=1)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[2].startswith('x2 '))
+        self.assertTrue(lines[4].startswith('x2 site 1 '))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,106 +10,66 @@ access from some txn causes 2 other txn a to be aborted (each from some cycle
 completed by the added edges from the write access) before the next command
 is even processed)
 
+Odd variables are used so that every lock lives on a single site.
 """
 
 import unittest
-import logging
-from collections import defaultdict, namedtuple
-
-MValue = namedtuple('MValue', ['value', 'version'])
-
-
-class Lock(object):
-    read = 17
-    write = 23
-
-    def __init__(self): # _lh stands for 'lock holder' and _q is 'queue'.
-        self._lh = []   # lh holds tuples (lock_type, tid) of txns holding locks
-        self._q = []    # q also holds tuples (lock_type, tid) of tnxs waiting for lock
-
-class LockManager(object):
-    def __init__(self):
-        self._lock_q = [Lock() for _ in range(20)]
-
-class SiteEntry(object):
-    def __new__(cls, zindex, sindex):
-        if (zindex+1) % 2 == 1 and (zindex+2) % 10 != sindex:
-            return None
-        else:
-            # this returns a new SiteEntry(zindex, sindex) object
-            return super().__new__(cls)
-
-    def __init__(self, zindex, sindex):
-        self._index = zindex + 1
-        self._sindex = sindex
-        self._values = [MValue(self._index*10, 0)]
-        self._isfailed = False
-        self._fail_version = -1
-        # logger.info(self._values)
-
-class Site(object):
-    def __init__(self, site_number):
-        # Simpler to do this here
-        self._site_number = site_number + 1
-        self._db = [SiteEntry(i, self._site_number) for i in range(20)]
-        self._lm = LockManager()
-        self._isfailed = False
-
-class Database(object):
-    def __init__(self):
-        self._sites = []  # self._sites = Database() looks like [Site(0), Site(1),..., Site(9)]
-        self._allsites = 10
-        for i in range(self._allsites):
-            self._sites.append(Site(i))
-
-class Test(object):
-    def __init__(self):
-        self._sites = Database()
-
-    def youngest(self, path):
-        youngest = None
-        for item in path:
-            txn = self._cur_txns[item]
-            if youngest is None or youngest[1] < txn.timestamp:
-                youngest = (txn.tid, txn.timestamp)
-        logger.info('DL detect abort triggered for txn {} on path {}'.format(youngest[0], path))
-        return youngest[0]
-
-    def tick(self):
-        self._time += 1
-        self.dl_detect()
-
-    def dfs(v, edges, path):
-        path.add(v)
-        for n in edges[v]:
-            if n in path or dfs(n, edges, path):
-                return True
-        path.remove(v)
-        return False
-
-    # Need these functions: self._sites._sites = Database()._sites, youngest()
-    def dl_detect(self):
-        """
-            dl_detect works by collecting edges from each site then doing
-            dfs on the edges
-        """
-        edges = defaultdict(lambda: set())
-        for site in self._sites._sites:
-            site.dl_detect(edges)
-        edges = dict(edges)
-
-        p_dead = None
-        for v in edges:
-            path = set()
-            if dfs(v, edges, path):
-                p_dead = path
-                break
-
-        if p_dead is not None:
-            logger.info('DL detect at site {}'.format(site._site_number))
-            self.abort(self.youngest(path))
-            return
-
-t = Test()
-t._sites._sites.append()
 
+from .results import Collector
+from .transaction_manager import TransactionManager
+
+
+class TestDLDetect(unittest.TestCase):
+    def setUp(self):
+        self._sink = Collector()
+        self._tm = TransactionManager(sink=self._sink)
+
+    def run_cmds(self, *cmds):
+        self._sink.clear()
+        for fn, *args in cmds:
+            getattr(self._tm, fn)(*args)
+        return self._sink.lines()
+
+    def aborted(self, lines):
+        return [l.split()[0] for l in lines if 'aborts' in l]
+
+    def test_long_cycle(self):
+        self.run_cmds(('new_txn', 1), ('new_txn', 2), ('new_txn', 3),
+                      ('new_txn', 4),
+                      ('write', 1, 1, 1), ('write', 2, 3, 1),
+                      ('write', 3, 5, 1), ('write', 4, 7, 1),
+                      ('write', 1, 3, 2), ('write', 2, 5, 2),
+                      ('write', 3, 7, 2))
+        # T4 closes T1 -> T2 -> T3 -> T4 -> T1
+        lines = self.run_cmds(('write', 4, 1, 2))
+        self.assertEqual(self.aborted(lines), ['T4'])
+        self.assertEqual(lines[-1], 'x7 = 2 (T3)')
+
+    def test_two_cycles_one_victim(self):
+        self.run_cmds(('new_txn', 1), ('new_txn', 2), ('new_txn', 3),
+                      ('read', 1, 7), ('read', 2, 7), ('read', 3, 5),
+                      ('write', 1, 5, 1), ('write', 2, 5, 2))
+        # T3 waits for both readers of x7: T1 -> T3 -> T1 and
+        # T2 -> T1 -> T3 -> T2, both broken by aborting T3
+        lines = self.run_cmds(('write', 3, 7, 3))
+        self.assertEqual(self.aborted(lines), ['T3'])
+        self.assertIn(1, self._tm._cur_txns)
+        self.assertIn(2, self._tm._cur_txns)
+        self.assertFalse(self._tm._waits_for.changed)
+
+    def test_two_cycles_two_victims(self):
+        self.run_cmds(('new_txn', 1), ('new_txn', 2), ('new_txn', 3),
+                      ('read', 2, 1), ('read', 3, 1),
+                      ('write', 1, 3, 10), ('write', 2, 3, 20),
+                      ('write', 3, 3, 30))
+        # T1 now waits for both readers of x1, completing T1 -> T2 -> T1 and
+        # T1 -> T3 -> T1. Both are aborted before the next command.
+        lines = self.run_cmds(('write', 1, 1, 11))
+        self.assertEqual(sorted(self.aborted(lines)), ['T2', 'T3'])
+        self.assertEqual(lines[-1], 'x1 = 11 (T1)')
+        self.assertEqual(list(self._tm._cur_txns), [1])
+        self.assertEqual(len(self._tm._waits_for), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+"""
+Classes:
+    Topology: number of sites, number of variables and the placement of each
+              variable's copies on the sites.
+    TestTopology: Unit tests for Topology.
+"""
+import unittest
+
+
+def default_placement(var, sitec):
+    """
+        Even variables are replicated at every site. Odd variable i is only
+        stored at site 1 + i mod sitec.
+    """
+    if var % 2 == 0:
+        return range(1, sitec + 1)
+    return [1 + var % sitec]
+
+
+class Topology(object):
+    """
+        Layout of the database shared by Database, Site, SiteEntry and
+        TransactionManager. placement(var, sitec) returns the numbers of the
+        sites (1 to sitec) holding a copy of variable var (1 to varc).
+    """
+    def __init__(self, sitec=10, varc=20, placement=default_placement):
+        """
+            The placement is evaluated once here into an index of the replica
+            sites of every variable and the variables hosted by every site.
+            Equal replica tuples are shared, so fully replicated variables
+            all point at the same tuple.
+
+            Raises ValueError if a variable has no site, as its accesses
+            could only ever block.
+        """
+        if sitec < 1 or varc < 1:
+            raise ValueError('Need at least one site and one variable')
+        self._sitec = sitec
+        self._varc = varc
+        self._replicas = [()]
+        hosted = [[] for _ in range(sitec + 1)]
+        shared = {}
+        for var in range(1, varc + 1):
+            sites = tuple(s for s in placement(var, sitec) if 1 <= s <= sitec)
+            sites = shared.setdefault(sites, sites)
+            self._replicas.append(sites)
+            for s in sites:
+                hosted[s].append(var)
+        self._hosted = [tuple(h) for h in hosted]
+        unplaced = [var for var in self.variables if not self._replicas[var]]
+        if unplaced:
+            raise ValueError('Variables {} are not stored at any site'
+                             .format(unplaced))
+
+    @property
+    def sitec(self):
+        return self._sitec
+
+    @property
+    def varc(self):
+        return self._varc
+
+    @property
+    def sites(self):
+        return range(1, self._sitec + 1)
+
+    @property
+    def variables(self):
+        return range(1, self._varc + 1)
+
+    def replicas(self, var):
+        """
+            Sites holding a copy of var, in increasing order.
+        """
+        return self._replicas[var]
+
+    def hosted(self, site):
+        """
+            Variables stored at site, in increasing order.
+        """
+        return self._hosted[site]
+
+    def hosts(self, site, var):
+        return site in self._replicas[var]
+
+    def replicated(self, var):
+        return len(self._replicas[var]) > 1
+
+
+class TestTopology(unittest.TestCase):
+    def setUp(self):
+        self.t = Topology()
+
+    def test_default(self):
+        self.assertEqual(self.t.replicas(2), tuple(range(1, 11)))
+        self.assertIs(self.t.replicas(2), self.t.replicas(4))
+        self.assertEqual(self.t.replicas(3), (4,))
+        self.assertEqual(self.t.replicas(9), (10,))
+        self.assertEqual(self.t.hosted(10), (2, 4, 6, 8, 9, 10, 12, 14, 16,
+                                             18, 19, 20))
+        self.assertEqual(self.t.hosted(4), (2, 3, 4, 6, 8, 10, 12, 13, 14,
+                                            16, 18, 20))
+        self.assertTrue(self.t.replicated(20))
+        self.assertFalse(self.t.replicated(11))
+        self.assertTrue(self.t.hosts(2, 11))
+        self.assertFalse(self.t.hosts(3, 11))
+
+    def test_custom(self):
+        t = Topology(4, 8, lambda var, sitec: [1 + var % sitec])
+        self.assertEqual(list(t.sites), [1, 2, 3, 4])
+        self.assertEqual(t.replicas(6), (3,))
+        self.assertEqual(t.hosted(3), (2, 6))
+        self.assertFalse(t.replicated(6))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            Topology(0, 20)
+        with self.assertRaises(ValueError):
+            Topology(4, 8, lambda var, sitec: [] if var == 5 else [1])
+
+    def test_other_site_counts(self):
+        for sitec in (1, 2, 3, 7, 10, 11):
+            t = Topology(sitec, 20)
+            self.assertTrue(all(t.replicas(var) for var in t.variables))
+        t = Topology(2, 20)
+        self.assertEqual((t.replicas(3), t.replicas(5)), ((2,), (2,)))
+        self.assertEqual(t.hosted(1), tuple(range(2, 21, 2)))
+
+    def test_two_sites(self):
+        from .results import Collector, Read, Write
+        from .transaction_manager import TransactionManager
+        tm = TransactionManager(topology=Topology(2, 20), sink=Collector())
+        tm.new_txn(1)
+        self.assertEqual(tm.read(1, 3), Read(1, 3, 30, 0, 2))
+        self.assertEqual(tm.write(1, 5, 51), Write(1, 5, 51, [2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,365 @@
+"""
+Authors Conrad Christensen
+
+Classes:
+    CommandType: the commands of a trace.
+    Parser: Class that matches regular expressions to file input to determine
+            what command is input'd and what arguments are provided
+    StreamParser: Parser reading a binary file in large blocks.
+    TestTrace: Unit tests for Parser and compiled traces.
+
+Compiled traces hold the commands of a text trace as fixed width records of
+RECORD_WORDS little-endian 64 bit integers: the CommandType value, then the
+arguments padded with zeros. They follow the 8 byte MAGIC header, which keeps
+the records aligned, so a compiled trace is replayed straight from a memory map
+with no parsing.
+"""
+import io
+import os
+import re
+import sys
+import enum
+import mmap
+import stat
+import logging
+import tempfile
+import unittest
+from array import array
+from collections import namedtuple
+
+logger = logging.getLogger('txn_manager')
+
+# Command object defined along with the types of commands
+Command = namedtuple('Command', ['type', 'args'])
+
+class CommandType(enum.Enum):
+    begin = 0
+    beginRO = 1
+    read = 2
+    write = 3
+    dump_all = 4
+    dump_site = 5
+    dump_variable = 6
+    end = 7
+    fail = 8
+    recover = 9
+
+
+def combine(syntax):
+    """
+        Joins the (type, regex) pairs of syntax into one regex with an
+        alternative per command, tried in order, so a line is matched once.
+        Every alternative ends with an empty group, whose number (the
+        lastindex of the match) tells which one matched. Returns the regex and
+        a dict lastindex -> (type, slice of the argument groups).
+    """
+    alternatives = {}
+    group = 0
+    for type_, regex in syntax:
+        first = group
+        group += re.compile(regex).groups + 1
+        alternatives[group] = (type_, slice(first, group - 1))
+    # No front anchors needed because we use re.match, and back anchor is only
+    # required if no comment start is found
+    pattern = re.compile('(?:{})(?://|$)'.format(
+        '|'.join(regex + '()' for _, regex in syntax)))
+    return pattern, alternatives
+
+
+class Parser(object):
+    # Syntax of each command once lowercased and without blanks. Blank and
+    # comment lines are the None type.
+    syntax = (
+        (CommandType.begin, r'begin\(t([0-9]+)\)'),
+        (CommandType.beginRO, r'beginro\(t([0-9]+)\)'),
+        (CommandType.read, r'r\(t([0-9]+),x([0-9]+)\)'),
+        (CommandType.write, r'w\(t([0-9]+),x([0-9]+),([0-9]+)\)'),
+        (CommandType.dump_all, r'dump\(\)'),
+        (CommandType.dump_site, r'dump\(([0-9]+)\)'),
+        (CommandType.dump_variable, r'dump\(x([0-9]+)\)'),
+        (CommandType.end, r'end\(t([0-9]+)\)'),
+        (CommandType.fail, r'fail\(([0-9]+)\)'),
+        (CommandType.recover, r'recover\(([0-9]+)\)'),
+        (None, r'\s*'),
+    )
+    pattern, alternatives = combine(syntax)
+
+    def __init__(self, file_handle):
+        self._started_iter = False
+        self._iter = iter(file_handle)
+        logger.info("Create Parser object")
+
+    def __iter__(self):
+        """
+            Create iterator of the parser and returns. Note that the iterator
+            is just the parser itself (but this should be called to ensure
+            it only gets called once.
+        """
+        if self._started_iter:
+            raise ValueError('Cannot iterate twice')
+        self._started_iter = True
+        return self
+
+    def __next__(self):
+        """
+            This function pulls the next line of data from the file and returns
+            a Command object denoting the type and arguments (directly from the
+            regex match). If the line was a comment then a None type returned
+            with the argument replaced by the actual line read.
+        """
+        assert self._started_iter, 'Must start iterator to call next'
+
+        oline = next(self._iter)
+        line = oline.lower().replace(' ', '').replace('\t', '')
+
+        match = Parser.pattern.match(line)
+        if match is None:
+            raise ValueError('No matches for line: {}'.format(oline))
+        type_, args = Parser.alternatives[match.lastindex]
+        if type_ is None:
+            return Command(None, oline)
+        return Command(type_, tuple(map(int, match.groups()[args])))
+
+# Bytes read at a time by StreamParser
+BLOCK_SIZE = 1 << 20
+
+
+def read_blocks(fp, block_size=BLOCK_SIZE):
+    """
+        Yields the content of the binary file fp in blocks of block_size
+        bytes. A regular file is memory mapped and read sequentially, anything
+        else (a pipe or a terminal on stdin) is read block by block.
+    """
+    try:
+        info = os.fstat(fp.fileno())
+    except (AttributeError, io.UnsupportedOperation):
+        info = None
+    if info is not None and stat.S_ISREG(info.st_mode) and info.st_size:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            for pos in range(0, info.st_size, block_size):
+                yield mm[pos:pos + block_size]
+        return
+    while True:
+        block = fp.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+class StreamParser(object):
+    """
+        Parser for a binary file object, such as sys.stdin.buffer or a file
+        opened with 'rb'. It matches the lines of each block read by
+        read_blocks against the bytes version of Parser.pattern, so only one
+        block and the line cut at its end are held at a time, and only
+        comment lines are decoded. Commands are the same as those of Parser
+        on the file opened as text.
+    """
+    pattern = re.compile(Parser.pattern.pattern.encode())
+
+    def __init__(self, fp, block_size=BLOCK_SIZE):
+        self._fp = fp
+        self._block_size = block_size
+        self._started_iter = False
+        logger.info("Create Parser object")
+
+    def __iter__(self):
+        if self._started_iter:
+            raise ValueError('Cannot iterate twice')
+        self._started_iter = True
+        return self._parse_blocks()
+
+    def _parse_blocks(self):
+        # The loop is inlined with locals as it runs once per line
+        match = self.pattern.match
+        alternatives = Parser.alternatives
+        rest = b''
+        for block in read_blocks(self._fp, self._block_size):
+            lines = block.split(b'\n')
+            lines[0] = rest + lines[0]
+            rest = lines.pop()
+            for line in lines:
+                found = match(
+                    line.lower().replace(b' ', b'').replace(b'\t', b''))
+                if found is None or line.endswith(b'\r'):
+                    # Errors and \r\n line ends
+                    yield self._parse(line, b'\n')
+                    continue
+                type_, args = alternatives[found.lastindex]
+                if type_ is None:
+                    yield Command(None, line.decode() + '\n')
+                else:
+                    yield Command(type_, tuple(map(int, found.groups()[args])))
+        if rest:
+            yield self._parse(rest, b'')
+
+    def _parse(self, line, end):
+        # As with universal newlines in text mode
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        match = self.pattern.match(
+            line.lower().replace(b' ', b'').replace(b'\t', b''))
+        if match is None:
+            raise ValueError('No matches for line: {}'.format(
+                (line + end).decode()))
+        type_, args = Parser.alternatives[match.lastindex]
+        if type_ is None:
+            return Command(None, (line + end).decode())
+        return Command(type_, tuple(map(int, match.groups()[args])))
+
+# What to log and which TransactionManager call to make for each command
+COMMANDS = {
+    CommandType.begin: ('Command %s for txn T%s',
+                        lambda tm, tid: tm.new_txn(tid)),
+    CommandType.beginRO: ('Command %s for txn T%s',
+                          lambda tm, tid: tm.new_txn(tid, read_only=True)),
+    CommandType.read: ('Command %s for txn T%s on var x%s',
+                       lambda tm, tid, var: tm.read(tid, var)),
+    CommandType.write: ('Command %s for txn T%s on var x%s and value %s',
+                        lambda tm, tid, var, value: tm.write(tid, var, value)),
+    CommandType.dump_all: ('Command %s', lambda tm: tm.dump()),
+    CommandType.dump_site: ('Command %s for site %s',
+                            lambda tm, site: tm.dump(site=site)),
+    CommandType.dump_variable: ('Command %s for variable x%s',
+                                lambda tm, var: tm.dump(var=var)),
+    CommandType.end: ('Command %s for txn T%s',
+                      lambda tm, tid: tm.finish_txn(tid)),
+    CommandType.fail: ('Command %s for site %s',
+                       lambda tm, site: tm.fail(site)),
+    CommandType.recover: ('Command %s for site %s',
+                          lambda tm, site: tm.recover(site)),
+}
+
+def do_cmd(tm, cmd):
+    log_fmt, run = COMMANDS[cmd.type]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(log_fmt, cmd.type, *cmd.args)
+    run(tm, *cmd.args)
+
+MAGIC = b'ADBTRC01'
+RECORD_WORDS = 4
+# Records written at a time when compiling
+COMPILE_BATCH = 1 << 14
+
+# Number of arguments of each type, and each type by opcode
+ARG_COUNT = {type_: args.stop - args.start
+             for type_, args in Parser.alternatives.values()}
+OPCODES = {type_.value: type_ for type_ in CommandType}
+
+
+def compile_trace(commands, out):
+    """
+        Writes the commands of a parsed trace compiled to the binary file out.
+        Blank and comment lines are dropped. Returns the number of commands
+        written.
+    """
+    out.write(MAGIC)
+    count = 0
+    words = array('q')
+    for cmd in commands:
+        if cmd.type is None:
+            continue
+        words.append(cmd.type.value)
+        words.extend(cmd.args)
+        words.extend((0,) * (RECORD_WORDS - 1 - len(cmd.args)))
+        count += 1
+        if len(words) >= COMPILE_BATCH * RECORD_WORDS:
+            _write_words(words, out)
+            words = array('q')
+    _write_words(words, out)
+    return count
+
+
+def _write_words(words, out):
+    if sys.byteorder == 'big':
+        words.byteswap()
+    words.tofile(out)
+
+
+def read_compiled(path):
+    """
+        Yields the Commands of the trace compiled at path. The file is memory
+        mapped and its records are read in place.
+    """
+    with open(path, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size < len(MAGIC) or fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a compiled trace'.format(path))
+        if size == len(MAGIC):
+            # Nothing to map
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)[len(MAGIC):]
+            if len(view) % (8 * RECORD_WORDS):
+                view.release()
+                raise ValueError('{} is truncated'.format(path))
+            if sys.byteorder == 'big':
+                words = array('q', view.tobytes())
+                words.byteswap()
+                view.release()
+                view = memoryview(words)
+            else:
+                view = view.cast('q')
+            try:
+                records = zip(*[iter(view)] * RECORD_WORDS)
+                for record in records:
+                    type_ = OPCODES[record[0]]
+                    yield Command(type_, record[1:1 + ARG_COUNT[type_]])
+            finally:
+                del records
+                view.release()
+
+
+class TestTrace(unittest.TestCase):
+    LINES = ['begin(T1)\n', '// comment\n', 'beginRO(T2) // ro\n',
+             'W(T1, x2, 102)\n', 'R(T2,x2)\n', '\n', 'dump()\n',
+             'dump(3)\n', 'dump(x4)\n', 'fail(2)\n', 'recover(2)\n',
+             'end(T1)']
+
+    def test_parse(self):
+        cmds = list(Parser(self.LINES))
+        self.assertEqual(cmds[0], Command(CommandType.begin, (1,)))
+        self.assertEqual(cmds[1], Command(None, '// comment\n'))
+        self.assertEqual(cmds[3], Command(CommandType.write, (1, 2, 102)))
+        self.assertEqual(cmds[6], Command(CommandType.dump_all, ()))
+        self.assertEqual(cmds[8], Command(CommandType.dump_variable, (4,)))
+        with self.assertRaises(ValueError):
+            next(iter(Parser(['read(T1,x2)'])))
+
+    def test_compile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.bin')
+            with open(path, 'wb') as out:
+                self.assertEqual(compile_trace(Parser(self.LINES), out), 10)
+            self.assertEqual(os.path.getsize(path),
+                             len(MAGIC) + 10 * 8 * RECORD_WORDS)
+            self.assertEqual(list(read_compiled(path)),
+                             [c for c in Parser(self.LINES)
+                              if c.type is not None])
+            with open(path, 'wb') as out:
+                compile_trace(Parser([]), out)
+            self.assertEqual(list(read_compiled(path)), [])
+            with open(path, 'wb') as out:
+                out.write(b'begin(T1)')
+            with self.assertRaises(ValueError):
+                list(read_compiled(path))
+
+    def test_stream(self):
+        data = ''.join(self.LINES)
+        expected = list(Parser(self.LINES))
+        for block_size in (1, 7, 1 << 20):
+            self.assertEqual(
+                list(StreamParser(io.BytesIO(data.encode()), block_size)),
+                expected)
+        with tempfile.TemporaryFile() as fp:
+            fp.write(data.replace('\n', '\r\n').encode())
+            fp.seek(0)
+            self.assertEqual(list(StreamParser(fp, 5)), expected)
+        with self.assertRaises(ValueError):
+            list(StreamParser(io.BytesIO(b'begin(T1)\nread(T1,x2)\n')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -31,10 +31,15 @@ class Transaction(object):
         self._tid = tid
         self._timestamp = timestamp
         self._accesses = []
-        self._writes = []
+        # var -> [value, sites]: the last value written to var and every
+        # site it was written at, applied once per replica on commit
+        self._write_set = {}
 
         self._rlocks = set()
         self._wlocks = set()
+        # Every (site, var) this transaction asked to lock, granted or still
+        # queued, so that only those locks are visited on commit or abort
+        self._lock_requests = set()
         self._abort = False
         self._reason = None
 
@@ -46,16 +51,23 @@ class Transaction(object):
         return 'T{}@{}'.format(self._tid, self._timestamp)
 
     def fail_site(self, site):
+        """
+            The locks held at site are lost with its lock table, so they are
+            requested again if the site recovers before this transaction
+            finishes.
+        """
         if site in self._accessed_sites:
             self.abort_fail(site)
+        self._rlocks = {lock for lock in self._rlocks if lock[0] != site}
+        self._wlocks = {lock for lock in self._wlocks if lock[0] != site}
 
     @property
-    def even_writes(self):
-        ws = []
-        for ac in self._accesses:
-            if ac.type == AccessType.write and ac.variable % 2 == 0:
-                ws.append(ac.variable)
-        return ws
+    def written(self):
+        return list(self._write_set)
+
+    @property
+    def write_set(self):
+        return self._write_set
 
     @property
     def tid(self):
@@ -73,13 +85,23 @@ class Transaction(object):
     def all_locks(self):
         return self._rlocks.union(self._wlocks)
 
+    @property
+    def lock_requests(self):
+        return self._lock_requests
+
     @property
     def abort_reason(self):
         return self._reason
 
+    def add_lock_request(self, site, var):
+        self._lock_requests.add((site, var))
+
     def add_rlock(self, site, var):
         self._rlocks.add((site, var))
 
+    def remove_rlock(self, site, var):
+        self._rlocks.discard((site, var))
+
     def has_rlock(self, site, var):
         return (site, var) in self._rlocks or (site, var) in self._wlocks
 
@@ -93,6 +115,14 @@ class Transaction(object):
         self._abort = True
         self._reason = 'deadlock'
 
+    def abort_prevention(self, policy):
+        self._abort = True
+        self._reason = policy
+
+    def abort_timeout(self):
+        self._abort = True
+        self._reason = 'lock timeout'
+
     def abort_fail(self, site):
         self._abort = True
         self._reason = 'site {} failure'.format(site)
@@ -100,23 +130,29 @@ class Transaction(object):
     def write(self, var, value, sites):
         self._accesses.append(
             Access(AccessType.write, var, value, self.timestamp))
-        self._accessed_sites = self._accessed_sites.union(sites)
-
-        def flush(DB, ts, sites=sites, var=var, value=value):
-            for s in sites:
-                DB[s].write(var, value, ts)
-        self._writes.append(flush)
-
-    def read(self, var, mval, site):
+        self._accessed_sites.update(sites)
+        pending = self._write_set.get(var)
+        if pending is None:
+            self._write_set[var] = [value, set(sites)]
+        else:
+            pending[0] = value
+            pending[1].update(sites)
+
+    def read(self, var, mval, site=None):
+        """
+            site is None when the value came from the write set.
+        """
         self._accesses.append(
             Access(AccessType.read, var, mval.value, mval.version))
-        self._accessed_sites.add(site)
+        if site is not None:
+            self._accessed_sites.add(site)
 
     def commit(self):
         """
-            Checks that transaction can commit and drops all locks
+            Checks that transaction can commit and drops all locks. Returns
+            whether it commits and the write set to apply.
         """
-        return not self._abort, self._writes
+        return not self._abort, self._write_set
 
 class ReadOnlyTransaction(Transaction):
     @property
@@ -130,7 +166,7 @@ class ReadOnlyTransaction(Transaction):
         return super().__repr__() + '(RO)'
 
     def commit(self):
-        return not (self._abort and not (self._abort)), []
+        return not (self._abort and not (self._abort)), {}
 
 
 class TestTransaction(unittest.TestCase):
@@ -146,6 +182,9 @@ class TestTransaction(unittest.TestCase):
 
     def test_fail_site(self):
         self.assertFalse(self.t._abort)
+        self.t.fail_site(8)
+        self.assertTrue(self.t.has_rlock(6, 5))
+        self.assertFalse(self.t.has_wlock(8, 7))
 
     def test_tid(self):
         self.assertEqual(self.t.tid, (3))
@@ -171,19 +210,30 @@ class TestTransaction(unittest.TestCase):
         self.t.add_wlock(4, 14)
         self.assertTrue(self.t.has_wlock(4, 14), {(4, 14)})
 
+    def test_lock_requests(self):
+        self.t.add_lock_request(2, 1)
+        self.t.add_lock_request(2, 1)
+        self.t.add_lock_request(4, 14)
+        self.assertEqual(self.t.lock_requests, {(2, 1), (4, 14)})
+
     def test_abort_dl(self):
         self.t.abort_dl()
         self.assertTrue(self.t._abort)
 
     def test_write(self):
-        pass
+        self.t.write(4, 40, [1, 2])
+        self.t.write(4, 41, [2, 3])
+        self.t.write(5, 50, [6])
+        self.assertEqual(self.t.write_set, {4: [41, {1, 2, 3}], 5: [50, {6}]})
+        self.assertEqual(self.t.written, [4, 5])
+        self.assertEqual(self.t._accessed_sites, {(2, 5), 1, 2, 3, 6})
 
     def test_read(self):
         pass
 
     def test_commit(self):
         self.t.abort_dl()
-        self.assertEqual(self.t.commit(), (False, []))
+        self.assertEqual(self.t.commit(), (False, {}))
 
 class TestReadOnlyTransaction(unittest.TestCase):
     def setUp(self):
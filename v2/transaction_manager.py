@@ -11,11 +11,19 @@ Classes:
     TestDatabase: Unit tests for Database class
     TestTM: Unit tests for TransactionManager
 """
+import io
+import enum
 import unittest
 import logging
-from collections import defaultdict
+import functools
+import contextlib
+from time import perf_counter_ns
 
-from .sites import Site
+from .lock_manager import WaitsForGraph, Prevention
+from .sites import MValue, Site, Storage
+from .topology import Topology
+from .results import (Abort, Blocked, Collector, Commit, Dump, PrintSink,
+                      Read, Write)
 from .transaction import Transaction, ReadOnlyTransaction
 
 
@@ -23,13 +31,29 @@ logger = logging.getLogger('txn_manager')
 
 class Database(object):
     """
-        Creates a database of 10 Site objects.
+        Creates a database of Site objects, 10 with the default topology. All
+        lock managers share the waits-for graph, if one is given.
+
+        Which sites are up is kept in the _up bitmap (indexed by site number)
+        next to the placement index of the topology, so finding a replica to
+        read or the replicas to write is a lookup. The writable replicas of a
+        variable are cached until a site fails or recovers, and so is its
+        first readable replica, which a committed write to a stale copy can
+        also change.
     """
-    def __init__(self):
+    def __init__(self, graph=None, topology=None, storage=None):
+        self._topology = topology or Topology()
         self._sites = []
-        self._allsites = 10
+        self._allsites = self._topology.sitec
         for i in range(self._allsites):
-            self._sites.append(Site(i))
+            self._sites.append(Site(i, graph, self._topology, storage))
+        self._up = bytearray(b'\x01') * (self._allsites + 1)
+        self._writable = {}
+        self._readable = {}
+
+    @property
+    def topology(self):
+        return self._topology
 
     def __setitem__(self, *args):
         if args:
@@ -38,42 +62,177 @@ class Database(object):
     def __getitem__(self, index):
         idx = index - 1
         if idx < 0 or idx >= self._allsites:
-            raise ValueError('{} does not exist. Value must be between 1 and 10'.format(idx))
+            raise ValueError('{} does not exist. Value must be between 1 and {}'
+                             .format(idx, self._allsites))
         return self._sites[idx]
 
+    def up(self, site):
+        return self._up[site] == 1
+
+    def fail(self, site):
+        self[site].fail()
+        self._up[site] = 0
+        self._writable = {}
+        self._readable = {}
+
+    def recover(self, site):
+        self[site].recover()
+        self._up[site] = 1
+        self._writable = {}
+        self._readable = {}
+
+    def write(self, site, var, value, version):
+        """
+            Commits a write of var at site.
+        """
+        s = self[site]
+        if s.stale(var):
+            # The copy becomes readable, maybe ahead of the cached one
+            self._readable.pop(var, None)
+        s.write(var, value, version)
+
+    def collect(self, watermark):
+        return sum(site.collect(watermark) for site in self._sites)
+
     def find_available(self, var, all=None):
+        if var < 1 or var > self._topology.varc:
+            raise ValueError('Illegal variable {}. Must be between 1 and {}'
+                             .format(var, self._topology.varc))
         if all:
-            available = []
-            for i in range(1, 11):
-                site = self[i]
-                if not site.failed and site[var]: available.append(i)
+            available = self._writable.get(var)
+            if available is None:
+                available = self._writable[var] = [
+                    s for s in self._topology.replicas(var) if self._up[s]]
             return available
         else:
-            for i in range(1, 11):
-                site = self[i]
-                if not site.failed and site[var] and (not site[var].failed): return i
-            return None
+            try:
+                return self._readable[var]
+            except KeyError:
+                pass
+            available = self._readable[var] = next(
+                (s for s in self._topology.replicas(var)
+                 if self._up[s] and not self._sites[s - 1].stale(var)), None)
+            return available
+
+    def find_snapshot(self, var, version):
+        """
+            First up site whose copy of var can be read as of version. The
+            first site find_available() gives may have failed since.
+        """
+        for s in self._topology.replicas(var):
+            if self._up[s] and self._sites[s - 1].readable_at(var, version):
+                return s
+        return None
+
+class DetectPolicy(enum.Enum):
+    """
+        When TransactionManager runs deadlock detection:
+            tick: after every command
+            block: only after a command that blocked on a lock
+            interval: every detect_interval ticks
+            never: not at all, deadlocks are only broken by lock timeouts
+    """
+    tick = 0
+    block = 1
+    interval = 2
+    never = 3
+
+
+def timed(method):
+    """
+        Records the latency of a TransactionManager operation in its Stats,
+        if it has any.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        if self._stats is None:
+            return method(self, *args, **kwargs)
+        return self._stats.time(name, method, self, *args, **kwargs)
+    return call
+
 
 class TransactionManager(object):
     """
         Manages transactions for each test case.
     """
 
-    def __init__(self, full_output=True, log_writes=True, test15_opt=True):
+    def __init__(self, full_output=True, log_writes=True, test15_opt=True,
+                 detect=DetectPolicy.tick, detect_interval=1,
+                 lock_timeout=None, prevention=None, topology=None,
+                 gc_interval=0, storage=None, sink=None, stats=None,
+                 contention=None):
+        """
+            detect chooses the DetectPolicy for deadlock detection, with
+            detect_interval used by DetectPolicy.interval. If lock_timeout is
+            set, a transaction blocked on a lock for more than that many ticks
+            is aborted whatever the policy.
+
+            prevention is a lock_manager.Prevention policy that stops
+            deadlocks from forming at all, in which case detect is ignored.
+
+            topology is the layout of sites and variables, by default the 10
+            sites and 20 variables of the project.
+
+            Every gc_interval ticks (never if 0) versions older than any
+            active read-only transaction can read are collected.
+
+            storage is the sites.Storage engine of every site.
+
+            Every operation returns its result (see the results module) and
+            gives it to sink, by default a PrintSink printing the text output
+            for full_output and log_writes.
+
+            stats is a stats.Stats recording the latency of every operation,
+            blocked times, retries, deadlock detection times and aborts.
+            Without it nothing is measured.
+
+            contention is a stats.Contention recording the lock queues, wait
+            ticks, upgrade conflicts and deadlock cycles of every variable.
+        """
+        if detect_interval < 1:
+            raise ValueError('Detect interval must be at least 1')
+        self._detect = detect
+        self._detect_interval = detect_interval
+        self._lock_timeout = lock_timeout
+        self._prevention = prevention
+        self._gc_interval = gc_interval
+        self._gc_stats = {'runs': 0, 'reclaimed': 0}
         self._test15_optimization = test15_opt
-        self._full_output = full_output
-        # Only log writes with full output
-        self._log_writes = self._full_output and log_writes
-        self._sites = Database()
+        self._sink = (PrintSink(full_output, log_writes) if sink is None
+                      else sink)
+        self._stats = stats
+        self._waits_for = WaitsForGraph(
+            prevention, timestamp=lambda tid: self._cur_txns[tid].timestamp)
+        self._sites = Database(self._waits_for, topology, storage)
+        self._topology = self._sites.topology
+        self._contention = contention
+        if contention is not None:
+            contention.watch(self._sites)
+        self._detecting = False
         self._cur_txns = {}
+        # Timestamps of the active read-only transactions, oldest first
+        self._snapshots = {}
         self._time = 1
 
-        # This holds accesses that were blocked due to failed sites. This needs
-        # to be checked when a site recovers, or there is a write to an even
-        # numbered variable
-        self._blocked_failed = set()
-
-        self._blocked_2pl = set()
+        # Blocked accesses, (tid, var) for reads and (tid, var, value) for
+        # writes, wait in queues keyed by what they wait for, each one a dict
+        # var -> {access: arrival number}:
+        # - a lock on var (_lock_waits),
+        # - a site holding var to recover (_site_waits),
+        # - a commit refreshing the replicated var, as a recovered copy cannot
+        #   be read before (_refresh_waits).
+        self._lock_waits = {}
+        self._site_waits = {}
+        self._refresh_waits = {}
+        # tid -> {access: queue it waits in}, to drop them when tid finishes
+        self._waiting = {}
+        self._arrivals = 0
+        # Set when an access blocks on a lock, for DetectPolicy.block
+        self._blocked_grew = False
+        # Tick at which each transaction started waiting on a lock
+        self._blocked_at = {}
 
     @property
     def time(self):
@@ -84,12 +243,61 @@ class TransactionManager(object):
         """
         return self._time
 
+    @property
+    def low_watermark(self):
+        """
+            Oldest timestamp an active read-only transaction may read at, or
+            the current time if there are none. Versions superseded at or
+            before it can never be read again.
+        """
+        return next(iter(self._snapshots.values()), self._time)
+
+    @property
+    def gc_stats(self):
+        return dict(self._gc_stats)
+
+    @property
+    def topology(self):
+        return self._topology
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @property
+    def contention(self):
+        return self._contention
+
+    def active(self, tid):
+        """
+            Whether tid began and has neither committed nor aborted.
+        """
+        return tid in self._cur_txns
+
+    def blocked(self, tid):
+        """
+            Whether an access of tid waits for a lock or a site.
+        """
+        return tid in self._waiting
+
+    def collect(self):
+        reclaimed = self._sites.collect(self.low_watermark)
+        self._gc_stats['runs'] += 1
+        self._gc_stats['reclaimed'] += reclaimed
+        logger.info('Collected %s versions below %s', reclaimed,
+                    self.low_watermark)
+
+    @timed
     def new_txn(self, tid, read_only=False):
+        self._snapshots.pop(tid, None)
+        if read_only:
+            self._snapshots[tid] = self.time
         self._cur_txns[tid] = (ReadOnlyTransaction if read_only
                                else Transaction)(tid, self.time)
-        logger.info('New transaction {}'.format(self._cur_txns[tid]))
+        logger.info('New transaction %s', self._cur_txns[tid])
         self.tick()
 
+    @timed
     def finish_txn(self, tid):
         """
             Test cases don't always call end() for all transactions even when
@@ -106,55 +314,144 @@ class TransactionManager(object):
 
         ws = None
         if commit:
-            for wf in writes:
-                wf(self._sites, self._time)
-            logger.info('Commit transaction {}. Accesses: {}'
-                        .format(self._cur_txns[tid], self._cur_txns[tid]._accesses))
-            print('T{} commits'.format(tid))
-            ws = txn.even_writes
+            # Each variable is written once per replica whatever the number of
+            # writes to it
+            for var, (value, sites) in writes.items():
+                for s in sites:
+                    self._sites.write(s, var, value, self._time)
+            logger.info('Commit transaction %s. Accesses: %s', txn,
+                        txn._accesses)
+            result = self._emit(Commit(tid))
+            ws = [v for v in txn.written if self._topology.replicated(v)]
         else:
-            logger.info('Abort transaction {}. Accesses: {}'
-                        .format(self._cur_txns[tid], self._cur_txns[tid]._accesses))
-            reason = (' ({})'.format(txn.abort_reason) \
-                      if self._full_output else '')
-            print('T{} aborts{}'.format(tid, reason))
+            logger.info('Abort transaction %s. Accesses: %s', txn,
+                        txn._accesses)
+            result = self._emit(Abort(tid, txn.abort_reason))
+        if self._stats is not None:
+            self._stats.finish(tid, None if commit else txn.abort_reason)
 
         # After finishing a transaction this releases all its locks. It also
         # notifies any other transactions waiting for a lock. Collects info about
         # who acquired a lock and runs unblock_2pl(). It checks to see who is
         # still waiting for a lock and execute their last command. If it doesn't
         # succeed then it goes back self.block_2pl().
+        # Only the locks this transaction requested are visited, in the same
+        # site then variable order as a full sweep.
         to_wake = set()
-        logger.info('Txn {} releasing locks'.format(txn))
-        for site in range(1, 11):
-            to_wake = to_wake.union(set(self._sites[site].unlock(txn.tid)))
+        logger.info('Txn %s releasing locks', txn)
+        for site, var in sorted(txn.lock_requests):
+            to_wake.update((woken, var) for woken
+                           in self._sites[site].unlock(txn.tid, var))
 
-        logger.info('Txn {} lock release to wake {}'.format(txn, to_wake))
+        logger.info('Txn %s lock release to wake %s', txn, to_wake)
 
         del self._cur_txns[tid]
+        self._snapshots.pop(tid, None)
+        self._blocked_at.pop(tid, None)
+        for blocked in list(self._waiting.get(tid, ())):
+            self._unwait(blocked)
         self.tick()
         self.unblock_2pl(to_wake)
         if ws:
             self._recover_by_write(ws)
+        return result
 
     def abort(self, tid):
         self._cur_txns[tid].abort_dl()
         self.finish_txn(tid)
 
-    def unblock_2pl(self, to_wake):
-        old_set = self._blocked_2pl.copy()
-        self._blocked_2pl = set()
-
-        for blocked in old_set:
-            #logger.critical('blocked {} is {} in {}'.format(blocked, blocked[0], to_wake))
-            if blocked[0] in to_wake:
-                if len(blocked) == 3: # write
-                    self.write(*blocked) #, recover_use_site=True)
-                elif len(blocked) == 2:
-                    self.read(*blocked)
+    def _wait(self, queue, blocked):
+        """
+            Queues the blocked access in queue under its variable. An access
+            already waiting there keeps its place, one waiting in another
+            queue moves. Waiting for a site stops the lock timeout clock.
+        """
+        previous = self._waiting.get(blocked[0], {}).get(blocked)
+        if previous is not None and previous is not queue:
+            self._unwait(blocked)
+        self._arrivals += 1
+        queue.setdefault(blocked[1], {}).setdefault(blocked, self._arrivals)
+        self._waiting.setdefault(blocked[0], {})[blocked] = queue
+        if self._stats is not None:
+            self._stats.wait(blocked, 'lock' if queue is self._lock_waits
+                             else 'site', self._time)
+        if self._contention is not None and queue is self._lock_waits:
+            self._contention.wait(blocked, self._time)
+        if queue is not self._lock_waits:
+            self._lock_wait_over(blocked[0])
+
+    def _lock_wait_over(self, tid):
+        """
+            Forgets when tid started waiting for a lock, unless another of its
+            accesses still does.
+        """
+        if not any(queue is self._lock_waits
+                   for queue in self._waiting.get(tid, {}).values()):
+            self._blocked_at.pop(tid, None)
+
+    def _unwait(self, blocked):
+        waiting = self._waiting[blocked[0]]
+        queue = waiting.pop(blocked)
+        if not waiting:
+            del self._waiting[blocked[0]]
+        accesses = queue[blocked[1]]
+        del accesses[blocked]
+        if not accesses:
+            del queue[blocked[1]]
+        if self._stats is not None:
+            self._stats.unwait(blocked, self._time)
+        if self._contention is not None:
+            self._contention.unwait(blocked, self._time)
+
+    def _wake(self, woken):
+        """
+            Retries the blocked accesses of woken, a list of
+            (arrival, access), in arrival order. They queue again if they
+            still cannot go on.
+        """
+        woken.sort()
+        for _, blocked in woken:
+            self._unwait(blocked)
+        for _, blocked in woken:
+            if len(blocked) == 3: # write
+                self.write(*blocked)
             else:
-                self._blocked_2pl.add(blocked)
+                self.read(*blocked)
+
+    def _block_2pl(self, blocked):
+        self._wait(self._lock_waits, blocked)
+        self._blocked_grew = True
+        self._blocked_at.setdefault(blocked[0], self._time)
+
+    def unblock_2pl(self, to_wake):
+        """
+            to_wake holds the (tid, var) of the lock requests just granted.
+            Only the accesses of those transactions waiting on those
+            variables are retried.
+        """
+        woken = []
+        for var in {var for _, var in to_wake}:
+            for blocked, arrival in self._lock_waits.get(var, {}).items():
+                if (blocked[0], var) in to_wake:
+                    woken.append((arrival, blocked))
+        if self._stats is not None:
+            for _, blocked in woken:
+                self._stats.retry(blocked[0])
+        self._wake(woken)
 
+    def _emit(self, result):
+        self._sink.emit(result)
+        return result
+
+    def skip(self, tid):
+        """
+            Accesses of a transaction that was already aborted, e.g. by
+            deadlock prevention, or that never began are ignored.
+        """
+        logger.info('Ignoring access from unknown transaction T%s', tid)
+        self.tick()
+
+    @timed
     def read(self, tid, var):
         """
             Finds an available site to read. Checks if the site is up and if
@@ -164,17 +461,33 @@ class TransactionManager(object):
             are blocked because sites have failed. block_2pl() holds
             transactions that are blocked due to two phase locking.
         """
+        if tid not in self._cur_txns:
+            return self.skip(tid)
+        txn = self._cur_txns[tid]
+        pending = txn.write_set.get(var)
+        if pending is not None:
+            # Own uncommitted write, which needs neither a site nor a lock
+            mval = MValue(pending[0], txn.timestamp)
+            result = self._emit(Read(tid, var, mval.value, mval.version, None))
+            txn.read(var, mval)
+            logger.info('Transaction %s read own write of x%s value %s', txn,
+                        var, mval.value)
+            self.tick()
+            return result
         site = self._sites.find_available(var)
+        if site is not None and self._cur_txns[tid].read_only:
+            site = self._sites.find_snapshot(var,
+                                             self._cur_txns[tid].timestamp)
         if site is None:
-            logger.info('Transaction {} fail blocked trying to read x{}'.format(
-                self._cur_txns[tid], var))
-            #if self._blocked_failed.index((tid) < 0:
-            self._blocked_failed.add((tid, var))
-            if self._full_output:
-                print('T{} blocked reading x{} (no site)'.format(tid, var))
-            return self.tick()
-
-        txn = self._cur_txns[tid]
+            logger.info('Transaction %s fail blocked trying to read x%s', txn,
+                        var)
+            # A replicated copy that comes back has to be written before it
+            # can be read, while the only copy can be read on recovery
+            self._wait(self._refresh_waits if self._topology.replicated(var)
+                       else self._site_waits, (tid, var))
+            result = self._emit(Blocked(tid, var, None, 'no site'))
+            self.tick()
+            return result
 
         if txn.read_only:
             """
@@ -184,35 +497,34 @@ class TransactionManager(object):
                 it to crash if mval is none.
             """
             mval = self._sites[site].read(var, txn)
-            print('x{}: {}{}'.format(
-                var, mval.value, 
-                ' (T{})'.format(tid) if self._full_output else ''))
+            result = self._emit(Read(tid, var, mval.value, mval.version, site))
             txn.read(var, mval, site)
-            logger.info('Transaction {} read x{} at site {} value {} version {}'
-                        .format(self._cur_txns[tid], var, site, *mval))
+            logger.info('Transaction %s read x%s at site %s value %s '
+                        'version %s', txn, var, site, *mval)
             assert mval is not None, 'Readonly should not fail'
-            return self.tick()
+            self.tick()
+            return result
 
         # mval is a named tuple which holds value and version. Defined in Sites.py.
         mval = self._sites[site].read(var, txn)
 
         if mval is None:
-            #self._blocked_2pl.add((tid, var, site))
-            self._blocked_2pl.add((tid, var))
-            logger.info('Transaction {} blocked reading x{} at site {}'
-                        .format(self._cur_txns[tid], var, site))
-            if self._full_output:
-                print('T{} blocked reading x{} (no lock)'.format(tid, var))
-            return self.tick()
-
-        print('x{}: {}{}'.format(
-            var, mval.value, 
-            ' (T{})'.format(tid) if self._full_output else ''))
+            self._block_2pl((tid, var))
+            logger.info('Transaction %s blocked reading x%s at site %s', txn,
+                        var, site)
+            result = self._emit(Blocked(tid, var, None, 'no lock'))
+            self.tick()
+            return result
+
+        result = self._emit(Read(tid, var, mval.value, mval.version, site))
         txn.read(var, mval, site)
-        logger.info('Transaction {} read x{} at site {} value {} version {}'
-                    .format(self._cur_txns[tid], var, site, *mval))
+        self._blocked_at.pop(tid, None)
+        logger.info('Transaction %s read x%s at site %s value %s version %s',
+                    txn, var, site, *mval)
         self.tick()
+        return result
 
+    @timed
     def write(self, tid, var, value): # , recover_use_site=False):
         """
             Similar to read(). Gets all available sites. If Sites returns an
@@ -220,17 +532,19 @@ class TransactionManager(object):
             Tries to acquire every site it needs. If return fails, write() will
             add sites to need_locks().
         """
+        if tid not in self._cur_txns:
+            return self.skip(tid)
         sites = self._sites.find_available(var, all=True)
         txn = self._cur_txns[tid]
 
         # TODO: What would cause this to fail?
         if not sites:
-            logger.info('Transaction {} fail blocked trying to write x{}'.format(
-                self._cur_txns[tid], var))
-            self._blocked_failed.add((tid, var, value))
-            if self._log_writes:
-                print('T{} blocked writing x{} (no site)'.format(tid, var))
-            return self.tick()
+            logger.info('Transaction %s fail blocked trying to write x%s',
+                        txn, var)
+            self._wait(self._site_waits, (tid, var, value))
+            result = self._emit(Blocked(tid, var, value, 'no site'))
+            self.tick()
+            return result
 
 
         need_locks = []
@@ -246,89 +560,86 @@ class TransactionManager(object):
             # of newly revived sites. In this case the sites can be seen as
             # still down since they have not been written to.
             if (self._test15_optimization and len(need_locks) != len(sites) and
-                    all(self._sites[s][var].failed for s in need_locks)):
+                    all(self._sites[s].stale(var) for s in need_locks)):
                 for s in need_locks:
                     self._sites[s]._lm.leave_q(var, tid)
             else:
-                self._blocked_2pl.add((tid, var, value))
-                logger.info('Transaction {} blocked writing x{} at sites {}'
-                            .format(txn, var, need_locks))
-                if self._log_writes:
-                    print('T{} blocked writing x{} (need locks)'.format(tid, var))
-                return self.tick()
+                self._block_2pl((tid, var, value))
+                logger.info('Transaction %s blocked writing x%s at sites %s',
+                            txn, var, need_locks)
+                result = self._emit(Blocked(tid, var, value, 'need locks'))
+                self.tick()
+                return result
 
 
         # Success
-        if self._log_writes:
-            print('x{} = {} (T{})'.format(var, value, tid))
+        result = self._emit(Write(tid, var, value, sites))
         txn.write(var, value, sites)
-        logger.info('Transaction {} to write x{} at sites {} value {} version {}'
-                    .format(self._cur_txns[tid], var, sites, value,
-                            self._cur_txns[tid].timestamp))
+        self._blocked_at.pop(tid, None)
+        logger.info('Transaction %s to write x%s at sites %s value %s '
+                    'version %s', txn, var, sites, value, txn.timestamp)
 
         self.tick()
+        return result
 
+    @timed
     def dump(self, var=None, site=None):
         """
             Gives the committed values of all copies of all variables at all
-            sites sorted per site.
+            sites sorted per site. Returns a Dump per site.
         """
         assert (var is None or site is None), 'One argument must be None'
-        sites = list(range(1, 11) if site is None else [site])
-        vars_ = list(range(1, 21) if var is None else [var])
+        sites = list(self._topology.sites if site is None else [site])
+        results = []
         for s in sites:
-            str_base = 'site {} - '.format(s)
-            v_strs = []
-            for v in vars_:
-                val = self._sites[s].bypass_failed(v)
-                if val:
-                    # Bypass site entry failed also
-                    v_strs.append('x{}: {}'.format(v, val._values[0].value))
-            if v_strs:
-                print(str_base + ' '.join(v_strs))
+            if var is None:
+                values = self._sites[s].values()
+            else:
+                # Bypass site entry failed also
+                val = self._sites[s].bypass_failed(var)
+                values = [(var, val.latest.value)] if val else []
+            results.append(self._emit(Dump(s, values)))
+        return results
 
+    @timed
     def fail(self, site):
-        logger.info('Site {} failing'.format(site))
-        self._sites[site].fail()
+        logger.info('Site %s failing', site)
+        self._sites.fail(site)
         for txn in self._cur_txns.values():
             txn.fail_site(site)
 
-    def _recover_by_write(self, evens):
-        old_set = self._blocked_failed.copy()
-        self._blocked_failed = set()
-
-        for blocked in old_set:
-            #logger.critical('blocked {} is {} in {}'.format(blocked, blocked[0], to_wake))
-            if len(blocked) == 2 and blocked[1] in evens:
-                logger.info('Unblocking {} because of writes to {}'.format(blocked, evens))
-                self.read(*blocked)
-            else:
-                self._blocked_2pl.add(blocked)
+    def _recover_by_write(self, replicated):
+        """
+            Retries the reads waiting for a committed write to one of the
+            replicated variables.
+        """
+        woken = []
+        for var in replicated:
+            waiting = self._refresh_waits.get(var)
+            if waiting:
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info('Unblocking %s because of writes to %s',
+                                list(waiting), replicated)
+                woken.extend((arrival, blocked)
+                             for blocked, arrival in waiting.items())
+        self._wake(woken)
 
+    @timed
     def recover(self, site):
-        logger.info('Site {} recovering'.format(site))
-        self._sites[site].recover()
-        logger.info('BLOCKED QUEUE: {}'.format(self._blocked_failed))
-
-        old_set = self._blocked_failed.copy()
-        self._blocked_failed = set()
-
-        for blocked in old_set:
-            #logger.critical('blocked {} is {} in {}'.format(blocked, blocked[0], to_wake))
-            if blocked[1] % 2 == 0: # All sites will have even valued vars
-                if len(blocked) == 3: # write
-                    self.write(*blocked)
-                elif len(blocked) == 2:
-                    # Need to wait for a write...
-                    self._blocked_failed.add(blocked)
-            elif (blocked[1] + 1) % 10 == site:
-                if len(blocked) == 3: # write
-                    self.write(*blocked)
-                elif len(blocked) == 2:
-                    # Only copy, no need to block
-                    self.read(*blocked)
-            else:
-                self._blocked_2pl.add(blocked)
+        """
+            Retries the accesses waiting for a site holding their variable to
+            recover. Reads of replicated variables keep waiting for a write.
+        """
+        logger.info('Site %s recovering', site)
+        self._sites.recover(site)
+        logger.info('BLOCKED QUEUE: %s', self._site_waits)
+
+        woken = []
+        for var, waiting in self._site_waits.items():
+            if self._topology.hosts(site, var):
+                woken.extend((arrival, blocked)
+                             for blocked, arrival in waiting.items())
+        self._wake(woken)
 
     def youngest(self, path):
         """
@@ -339,42 +650,106 @@ class TransactionManager(object):
             txn = self._cur_txns[item]
             if youngest is None or youngest[1] < txn.timestamp:
                 youngest = (txn.tid, txn.timestamp)
-        logger.info('DL detect abort triggered for txn {} on path {}'.format(youngest[0], path))
+        logger.info('DL detect abort triggered for txn %s on path %s',
+                    youngest[0], path)
         return youngest[0]
 
+    def _victim(self, path):
+        """
+            Victim of the deadlock cycle of path, recorded with contention.
+        """
+        if self._contention is not None:
+            self._contention.cycle(path)
+        return self.youngest(path)
+
     def dl_detect(self):
         """
-            dl_detect works by collecting edges from each site then doing
-            dfs on the edges. Detects a deadlock and aborts the youngest transaction.
+            dl_detect works on the waits-for graph kept up to date by the lock
+            managers. A new cycle has to go through an edge added since the
+            last check, so only the transactions that gained edges are
+            searched. Every deadlock found is resolved in one batch by
+            aborting the youngest transaction of each cycle.
+
+            Aborting releases locks and may unblock others, which ticks and
+            comes back here; those calls are left to the loop below instead.
+            With stats, the time taken is recorded, aborts included.
         """
-        edges = defaultdict(lambda: set())
-        for site in self._sites._sites:
-            site.dl_detect(edges)
-        edges = dict(edges)
+        if self._detecting:
+            return
+        start = perf_counter_ns() if self._stats is not None else 0
+        self._detecting = True
+        try:
+            while self._waits_for.changed:
+                for tid in self._waits_for.victims(self._victim):
+                    if tid in self._cur_txns:
+                        self.abort(tid)
+        finally:
+            self._detecting = False
+        if self._stats is not None:
+            self._stats.detected(perf_counter_ns() - start)
 
-        p_dead = None
-        for v in edges:
-            path = set()
-            if dfs(v, edges, path):
-                p_dead = path
-                break
+    def timeout_waits(self):
+        """
+            Aborts every transaction that has been blocked on a lock for more
+            than lock_timeout ticks.
+        """
+        if self._detecting:
+            return
+        self._detecting = True
+        try:
+            expired = [tid for tid, since in self._blocked_at.items()
+                       if self._time - since > self._lock_timeout]
+            for tid in expired:
+                if tid in self._cur_txns:
+                    logger.info('Lock wait timeout for txn %s', tid)
+                    self._cur_txns[tid].abort_timeout()
+                    self.finish_txn(tid)
+        finally:
+            self._detecting = False
 
-        if p_dead is not None:
-            logger.info('DL detect at site {}'.format(site._site_number))
-            self.abort(self.youngest(path))
+    def prevent(self):
+        """
+            Aborts the transactions doomed by the deadlock prevention policy
+            when their lock requests were queued.
+        """
+        if self._detecting:
             return
+        self._detecting = True
+        try:
+            while self._waits_for.doomed:
+                for tid in self._waits_for.pop_doomed():
+                    if tid in self._cur_txns:
+                        self._cur_txns[tid].abort_prevention(
+                            self._prevention.value)
+                        self.finish_txn(tid)
+        finally:
+            self._detecting = False
 
     def tick(self):
         self._time += 1
-        self.dl_detect()
-
-def dfs(v, edges, path):
-    path.add(v)
-    for n in edges[v]:
-        if n in path or dfs(n, edges, path):
-            return True
-    path.remove(v)
-    return False
+        if self._contention is not None:
+            # Before deadlocks are broken, so their queues are seen too
+            self._contention.sample(self._time)
+        if self._prevention is not None:
+            # No cycles can form, so the graph is never searched
+            self._waits_for.clear()
+            self.prevent()
+        elif self._detect == DetectPolicy.tick:
+            self.dl_detect()
+        elif self._detect == DetectPolicy.block:
+            if self._blocked_grew:
+                self._blocked_grew = False
+                self.dl_detect()
+        elif self._detect == DetectPolicy.interval:
+            if self._time % self._detect_interval == 0:
+                self.dl_detect()
+        else:
+            # Nothing will look at the new edges
+            self._waits_for.clear()
+        if self._lock_timeout is not None and self._blocked_at:
+            self.timeout_waits()
+        if self._gc_interval and self._time % self._gc_interval == 0:
+            self.collect()
 
 
 class TestDatabase(unittest.TestCase):
@@ -389,6 +764,39 @@ class TestDatabase(unittest.TestCase):
         with self.assertRaises(ValueError):
             self.db.__getitem__(11)
 
+    def test_find_available(self):
+        self.assertEqual(self.db.find_available(3), 4)
+        self.assertEqual(self.db.find_available(3, all=True), [4])
+        self.db.fail(4)
+        self.assertEqual(self.db.find_available(3), None)
+        self.assertEqual(self.db.find_available(3, all=True), [])
+        self.db.fail(1)
+        self.assertEqual(self.db.find_available(2), 2)
+        self.assertEqual(len(self.db.find_available(2, all=True)), 8)
+        self.db.recover(1)
+        # Site 1 is back up but its copy of x2 is stale until written
+        self.assertEqual(self.db.find_available(2), 2)
+        self.assertEqual(len(self.db.find_available(2, all=True)), 9)
+        with self.assertRaises(ValueError):
+            self.db.find_available(21)
+
+    def test_readable_cache(self):
+        self.db.fail(1)
+        self.db.recover(1)
+        self.assertEqual(self.db.find_available(2), 2)
+        self.assertEqual(self.db._readable, {2: 2})
+        # Writing the stale copy at site 1 makes it the first readable one
+        self.db.write(1, 2, 21, 5)
+        self.assertEqual(self.db._readable, {})
+        self.assertEqual(self.db.find_available(2), 1)
+        self.db.write(1, 2, 22, 6)
+        self.assertEqual(self.db._readable, {2: 1})
+        self.db.fail(4)
+        self.assertEqual(self.db.find_available(3), None)
+        self.db.recover(4)
+        # x3 is only stored at site 4, so it is readable at once
+        self.assertEqual(self.db.find_available(3), 4)
+
     def test__setitem__(self):
         with self.assertRaises(ValueError):
             self.db.__setitem__((12))
@@ -402,12 +810,236 @@ class TestTM(unittest.TestCase):
     def test_init(self):
         self.assertEqual(len(self._tmgr._sites._sites), 10)
 
+    def test_topology(self):
+        tm = TransactionManager(topology=Topology(3, 6))
+        self.assertEqual(len(tm._sites._sites), 3)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            tm.dump()
+        self.assertEqual(out.getvalue().splitlines()[0],
+                         'site 1 - x2: 20 x3: 30 x4: 40 x6: 60')
+
+    def test_collect(self):
+        for storage in Storage:
+            with self.subTest(storage=storage):
+                tm = TransactionManager(storage=storage)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for tid in range(1, 4):
+                        tm.new_txn(tid)
+                        tm.write(tid, 2, tid)
+                        tm.finish_txn(tid)
+                    tm.new_txn(10, read_only=True)
+                    ts = tm.time - 1
+                    for tid in range(4, 6):
+                        tm.new_txn(tid)
+                        tm.write(tid, 2, tid)
+                        tm.finish_txn(tid)
+                    self.assertEqual(tm.low_watermark, ts)
+                    tm.collect()
+                    # Each site keeps T3's write for T10 plus the two newer
+                    # ones
+                    self.assertEqual(tm.gc_stats['reclaimed'], 10 * 3)
+                    tm.read(10, 2)
+                    tm.finish_txn(10)
+                    tm.collect()
+                    self.assertEqual(tm.gc_stats,
+                                     {'runs': 2, 'reclaimed': 10 * 5})
+
+    def test_write_set(self):
+        sink = Collector()
+        tm = TransactionManager(sink=sink)
+        tm.new_txn(1)
+        for value in range(100):
+            tm.write(1, 3, value)
+        self.assertEqual(tm.read(1, 3), Read(1, 3, 99, 1, None))
+        tm.new_txn(2)
+        self.assertEqual(tm.read(2, 5), Read(2, 5, 50, 0, 6))
+        self.assertEqual(tm.finish_txn(1), Commit(1))
+        self.assertEqual(sink.lines()[-3:],
+                         ['x3: 99 (T1)', 'x5: 50 (T2)', 'T1 commits'])
+        self.assertEqual(tm._sites[4][3].latest, MValue(99, tm.time - 1))
+        self.assertEqual(tm._sites[4][3].version_count, 2)
+
+    def test_wait_queues(self):
+        sink = Collector()
+        tm = TransactionManager(sink=sink)
+        for tid in range(1, 7):
+            tm.new_txn(tid)
+        tm.write(1, 1, 11)
+        self.assertEqual(tm.read(3, 1), Blocked(3, 1, None, 'no lock'))
+        tm.read(2, 1)
+        self.assertEqual(list(tm._lock_waits[1]), [(3, 1), (2, 1)])
+        tm.fail(4)
+        self.assertEqual(tm.read(4, 3), Blocked(4, 3, None, 'no site'))
+        tm.read(6, 3)
+        tm.finish_txn(6)
+        tm.write(5, 2, 22)
+        tm.finish_txn(5)
+        self.assertEqual([tm.blocked(tid) for tid in range(1, 6)],
+                         [False, True, True, True, False])
+        self.assertFalse(tm.active(5))
+        sink.clear()
+        committed = tm.time
+        tm.finish_txn(1)
+        # Committing a replicated write does not touch the read of x3,
+        # which waits for site 4 and not for a lock
+        self.assertEqual(tm._site_waits, {3: {(4, 3): 3}})
+        tm.recover(4)
+        self.assertEqual(sink.results,
+                         [Commit(1), Read(3, 1, 11, committed, 2),
+                          Read(2, 1, 11, committed, 2),
+                          Read(4, 3, 30, 0, 4)])
+        self.assertEqual((tm._lock_waits, tm._site_waits, tm._waiting),
+                         ({}, {}, {}))
+        self.assertFalse(tm.blocked(4))
+
+    def test_results(self):
+        sink = Collector(full_output=False)
+        tm = TransactionManager(sink=sink)
+        tm.new_txn(1)
+        tm.new_txn(2)
+        self.assertEqual(tm.write(1, 2, 21).sites, list(range(1, 11)))
+        self.assertEqual(tm.write(2, 2, 22), Blocked(2, 2, 22, 'need locks'))
+        tm.fail(3)
+        self.assertEqual(tm.finish_txn(1), Abort(1, 'site 3 failure'))
+        self.assertEqual(tm.dump(site=4), [Dump(4, tm._sites[4].values())])
+        # Writes and blocked accesses are not part of the minimum output
+        self.assertEqual(sink.lines(), [
+            'T1 aborts', 'site 4 - x2: 20 x3: 30 x4: 40 x6: 60 x8: 80 '
+            'x10: 100 x12: 120 x13: 130 x14: 140 x16: 160 x18: 180 x20: 200'])
+        # T2 gets the locks once T1 aborts, without failed site 3
+        self.assertEqual(sink.results[3],
+                         Write(2, 2, 22, [1, 2] + list(range(4, 11))))
+
     def test_time(self):
         self.assertEqual(self._tmgr.time, (1))
 
     def test_dl_detec(self):
         pass
 
+    def test_detect_interval(self):
+        with self.assertRaises(ValueError):
+            TransactionManager(detect=DetectPolicy.interval, detect_interval=0)
+
+    def test_detect_never(self):
+        tm = TransactionManager(detect=DetectPolicy.never)
+        with contextlib.redirect_stdout(io.StringIO()):
+            tm.new_txn(1)
+            tm.new_txn(2)
+            tm.write(1, 1, 10)
+            tm.write(2, 3, 30)
+            tm.write(1, 3, 11)
+            tm.write(2, 1, 31)
+        self.assertEqual(list(tm._cur_txns), [1, 2])
+
+    def test_requeued_upgrade(self):
+        tm = TransactionManager()
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            tm.new_txn(1)
+            tm.new_txn(2)
+            tm.read(1, 1)
+            tm.read(2, 1)
+            # T1 gives up its read lock to queue the upgrade, so the second
+            # write waits behind it as an ordinary write request
+            tm.write(1, 1, 11)
+            tm.write(1, 1, 12)
+            tm.finish_txn(2)
+        self.assertEqual(out.getvalue().splitlines()[-4:],
+                         ['T1 blocked writing x1 (need locks)',
+                          'T2 commits',
+                          'x1 = 11 (T1)',
+                          'x1 = 12 (T1)'])
+
+    def test_lost_locks(self):
+        tm = TransactionManager()
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            tm.new_txn(3)
+            tm.read(3, 3)
+            tm.fail(4)
+            tm.recover(4)
+            # The read lock went with site 4, so the write locks afresh
+            tm.write(3, 3, 33)
+            tm.finish_txn(3)
+        self.assertEqual(out.getvalue().splitlines(),
+                         ['x3: 30 (T3)', 'x3 = 33 (T3)',
+                          'T3 aborts (site 4 failure)'])
+
+    def test_snapshot_site(self):
+        tm = TransactionManager()
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            tm.fail(1)
+            tm.recover(1)
+            tm.new_txn(5, read_only=True)
+            tm.new_txn(6)
+            tm.write(6, 2, 62)
+            tm.finish_txn(6)
+            # Site 1 has x2 again, but failed after the version T5 reads
+            tm.read(5, 2)
+        self.assertEqual(out.getvalue().splitlines()[-1], 'x2: 20 (T5)')
+
+    def run_test1(self, prevention):
+        tm = TransactionManager(prevention=prevention)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            tm.new_txn(1)
+            tm.new_txn(2)
+            tm.write(1, 1, 101)
+            tm.write(2, 2, 202)
+            tm.write(1, 2, 102)
+            tm.write(2, 1, 201)
+        return tm, out.getvalue().splitlines()
+
+    def test_wait_die(self):
+        tm, lines = self.run_test1(Prevention.wait_die)
+        self.assertEqual(lines[-3:], ['T2 blocked writing x1 (need locks)',
+                                      'T2 aborts (wait-die)',
+                                      'x2 = 102 (T1)'])
+        self.assertEqual(list(tm._cur_txns), [1])
+
+    def test_wound_wait(self):
+        tm, lines = self.run_test1(Prevention.wound_wait)
+        self.assertEqual(lines[-3:], ['T1 blocked writing x2 (need locks)',
+                                      'T2 aborts (wound-wait)',
+                                      'x2 = 102 (T1)'])
+        self.assertEqual(list(tm._cur_txns), [1])
+
+    def test_lock_timeout(self):
+        tm = TransactionManager(detect=DetectPolicy.never, lock_timeout=2)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            tm.new_txn(1)
+            tm.new_txn(2)
+            tm.write(1, 1, 10)
+            tm.write(2, 3, 30)
+            tm.write(1, 3, 11)
+            tm.write(2, 1, 31)
+            tm.new_txn(3)
+            tm.new_txn(4)
+        self.assertIn('T1 aborts (lock timeout)', out.getvalue())
+        self.assertEqual(list(tm._cur_txns), [2, 3, 4])
+
+    def test_lock_then_site_wait(self):
+        sink = Collector()
+        tm = TransactionManager(detect=DetectPolicy.never, lock_timeout=2,
+                                sink=sink)
+        tm.new_txn(1)
+        tm.new_txn(2)
+        tm.write(1, 3, 31)
+        self.assertEqual(tm.read(2, 3), Blocked(2, 3, None, 'no lock'))
+        # The queued lock request goes with site 4, so T2 now only waits
+        # for it to recover, which the lock timeout leaves alone
+        tm.fail(4)
+        self.assertEqual(tm.read(2, 3), Blocked(2, 3, None, 'no site'))
+        self.assertEqual((tm._lock_waits, tm._blocked_at), ({}, {}))
+        for tid in (3, 4, 5):
+            tm.new_txn(tid)
+        self.assertTrue(tm.active(2))
+        tm.recover(4)
+        self.assertEqual(sink.results[-1], Read(2, 3, 30, 0, 4))
+
 
 if __name__ == '__main__':
     unittest.main()